@@ -0,0 +1,409 @@
+import os
+import sys
+import json
+import atexit
+import time
+import random
+import shutil
+import subprocess
+import argparse
+import platform
+import tempfile
+import contextlib
+import numpy as np
+import dvis
+from canvas import Canvas
+from clip import NULL
+from colors import Set3
+from phdb import HT, PHDBClip
+from quicksort import QuickSortClip
+from mergesort import MergeSortClip
+from leveldb import LevelDBClip
+from leveldb_trace import LevelDBTrace, convert, open_trace
+
+benchmarks = {}  # name -> setup function
+
+
+def bench(name):
+    """Register a benchmark. The decorated function does the setup and
+    returns the operation to time, or (operation, items) when one call
+    processes items things (boxes, keys, frames) to also report items/s."""
+    def wrap(fn):
+        benchmarks[name] = fn
+        return fn
+    return wrap
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+        yield
+
+
+@bench('canvas.box')
+def _():
+    c = Canvas(1280, 800)
+    xy = [(random.randrange(1200), random.randrange(700)) for i in range(1000)]
+
+    def op():
+        for x, y in xy:
+            c.box(x, y, 40, 30, Set3[x % 12])
+    return op, len(xy)
+
+
+@bench('canvas.boxes')
+def _():
+    c = Canvas(1280, 800)
+    x = np.random.default_rng(0).integers(0, 1200, 1000)
+    y = np.random.default_rng(1).integers(0, 700, 1000)
+    return (lambda: c.boxes(x, y, 40, 30, x % 12, palette=Set3)), len(x)
+
+
+@bench('canvas.text')
+def _():
+    c = Canvas(1280, 800)
+    texts = [str(i) for i in range(200)]
+
+    def op():
+        for i, t in enumerate(texts):
+            c.text(i * 6, 400, t, 18)
+    return op, len(texts)
+
+
+@bench('canvas.text_box_list')
+def _():
+    c = Canvas(1280, 800)
+    texts = [str(i) for i in range(30)]
+    return lambda: c.text_box_list(20, 20, 40, 20, texts, 'h')
+
+
+@bench('canvas.box_matrix')
+def _():
+    c = Canvas(1280, 800)
+    m = [[str(i * 16 + j) for j in range(16)] for i in range(16)]
+    return lambda: c.box_matrix(20, 20, 40, 24, m)
+
+
+@bench('canvas.heatmap')
+def _():
+    c = Canvas(1280, 800)
+    m = np.random.default_rng(0).integers(0, 12, (200, 256))
+    return lambda: c.heatmap(0, 0, 5, 4, m, palette=Set3, border=0)
+
+
+@bench('canvas.get_npimage')
+def _():
+    c = Canvas(1280, 800)
+    c.clear()
+    out = c.get_npimage()
+    return lambda: c.get_npimage(out=out)
+
+
+def check_retained(draw, frames, width=640, height=480):
+    """Read back frames drawn by draw(canvas, i) with full redraws and with
+    a retained canvas, failing unless they match byte for byte. Returns the
+    retained canvas."""
+    full, retained = Canvas(width, height), Canvas(width, height, retained=True)
+    for i in range(frames):
+        for c in (full, retained):
+            c.clear()
+            draw(c, i)
+        if not np.array_equal(full.get_npimage(), retained.get_npimage()):
+            raise Exception(f'retained frame {i} differs from a full redraw')
+    return retained
+
+
+def _retained_frame(c, i):
+    # left translated at readback, like LevelDBClip.render does
+    c.translate(70, 40)
+    for k in range(40):
+        c.box(k * 12, 100 + (k == i % 40) * 20, 10, 30, Set3[k])
+    c.text(200, 20, f'step {i}', 18)
+
+
+def _retained_heatmap(c, i):
+    m = np.arange(40 * 64).reshape(40, 64) + i
+    c.translate(10, 10)
+    c.heatmap(0, 0, 5, 4, m, palette=Set3, border=0)
+
+
+@bench('canvas.retained_heatmap')
+def _():
+    c = check_retained(_retained_heatmap, 3)
+    frame = [3]
+
+    def op():
+        c.clear()
+        _retained_heatmap(c, frame[0])
+        frame[0] += 1
+        c.get_npimage()
+    return op
+
+
+@bench('canvas.retained')
+def _():
+    c = check_retained(_retained_frame, 4)
+    frame = [4]
+
+    def op():
+        c.clear()
+        _retained_frame(c, frame[0])
+        frame[0] += 1
+        c.get_npimage()
+    return op
+
+
+@bench('dvis.tree')
+def _():
+    s = dvis.Surface(1280, 800)
+    tree = dvis.Group([dvis.TextBoxHList([str(i * 20 + j) for j in range(20)], 20, 40, x=640, y=40 + i * 30, fill=Set3[i])
+                       for i in range(20)])
+
+    def op():
+        s.clear()
+        s.draw(tree)
+    return op, 400
+
+
+@bench('phdb.put')
+def _():
+    keys = np.random.default_rng(0).integers(0, 0x100000000, 100000).tolist()
+
+    def op():
+        ht = HT(1 << 24, 20)
+        for k in keys:
+            ht.put(k)
+    return op, len(keys)
+
+
+@bench('phdb.put_many')
+def _():
+    keys = np.random.default_rng(0).integers(0, 0x100000000, int((1 << 28) * 0.85 / 20))
+    return (lambda: HT(1 << 28, 20).put_many(keys)), len(keys)
+
+
+@bench('phdb.reassign_overflows')
+def _():
+    ht = HT(1 << 28, 20)
+    ht.put_many(np.random.default_rng(0).integers(0, 0x100000000, int((1 << 28) * 0.85 / 20)))
+    return ht.reassign_overflows, ht.npage
+
+
+def make_trace(path, nstep=4000, seed=0):
+    """Write a synthetic leveldb trace log: flushes into L0 and compactions
+    of a level into the next one, each followed by a levels snapshot."""
+    rnd = random.Random(seed)
+    levels = [[] for i in range(7)]
+    fid = 0
+
+    def new_file(start, end):
+        nonlocal fid
+        fid += 1
+        return {'id': fid, 'start': start, 'end': end, 'size': rnd.randrange(1 << 20, 2 << 20)}
+
+    with open(path, 'w') as f:
+        for i in range(nstep):
+            full = [l for l in range(4) if len(levels[l]) > (4 if l == 0 else 10 ** l)]
+            if full:
+                l = full[0]
+                victims = levels[l][:4 if l == 0 else 2]
+                lo = min(v['start'] for v in victims)
+                hi = max(v['end'] for v in victims)
+                victims += [v for v in levels[l + 1] if v['start'] <= hi and v['end'] >= lo]
+                n = max(1, len(victims) - 1)
+                adds = [new_file(lo + (hi - lo) * k // n, lo + (hi - lo) * (k + 1) // n - 1) for k in range(n)]
+                f.write('cmp ' + json.dumps({'delete': [[l if v in levels[l] else l + 1, v['id']] for v in victims],
+                                             'add': [[l + 1, a['id']] for a in adds]}) + '\n')
+                levels[l] = [v for v in levels[l] if v not in victims]
+                levels[l + 1] = sorted([v for v in levels[l + 1] if v not in victims] + adds, key=lambda v: v['start'])
+            else:
+                s = rnd.randrange(11000000)
+                levels[0].append(new_file(s, s + rnd.randrange(100000, 1000000)))
+            f.write('lvl ' + json.dumps(levels) + '\n')
+
+
+_workdir = None
+
+
+def workdir():
+    """Scratch directory shared by the benchmarks, removed at exit."""
+    global _workdir
+    if _workdir is None:
+        _workdir = tempfile.mkdtemp(prefix='dvis-bench-')
+        atexit.register(shutil.rmtree, _workdir, True)
+    return _workdir
+
+
+def trace_log(name):
+    """A fresh copy of the synthetic trace log, so no cache next to it is reused."""
+    src = os.path.join(workdir(), 'trace.log')
+    if not os.path.exists(src):
+        make_trace(src)
+    path = os.path.join(workdir(), name)
+    shutil.copy(src, path)
+    return path
+
+
+@bench('leveldb.trace_lazy')
+def _():
+    path = trace_log('lazy.log')
+
+    def op():
+        # the line index is built every time
+        t = LevelDBTrace(path)
+        for i in range(len(t)):
+            t[i]
+        t.close()
+        os.remove(t.index_path)
+    return op, len(LevelDBTrace(path))
+
+
+@bench('leveldb.convert')
+def _():
+    path = trace_log('convert.log')
+    return (lambda: convert(path)), len(open_trace(path))
+
+
+@bench('leveldb.trace_columns')
+def _():
+    path = trace_log('columns.log')
+    convert(path)
+
+    def op():
+        t = open_trace(path)
+        for i in range(len(t)):
+            t[i]
+    return op, len(open_trace(path))
+
+
+def clip_bench(make):
+    def setup():
+        with quiet():
+            c = make()
+            c.run()
+        frames = c.throughput()['frames']
+
+        def op():
+            with quiet():
+                make().run()
+        return op, frames
+    return setup
+
+
+bench('clip.quicksort')(clip_bench(lambda: QuickSortClip(20, NULL)))
+bench('clip.mergesort')(clip_bench(lambda: MergeSortClip(20, NULL)))
+bench('clip.phdb')(clip_bench(lambda: PHDBClip(20, 1 << 20, 0.87, path=NULL)))
+
+
+@bench('clip.leveldb')
+def _():
+    path = trace_log('clip.log')
+    return clip_bench(lambda: LevelDBClip(path, NULL))()
+
+
+def startup_bench(*args):
+    """Wall time of a fresh interpreter running args, from the repo directory."""
+    cmd = [sys.executable, *args]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    def setup():
+        return lambda: subprocess.run(cmd, cwd=cwd, stdout=subprocess.DEVNULL, check=True)
+    return setup
+
+
+# the heavy backends must stay unimported until a clip actually uses them
+bench('startup.import_clip')(startup_bench(
+    '-c', "import sys, clip; assert not {'cv2', 'moviepy', 'imageio'} & set(sys.modules)"))
+bench('startup.import_examples')(startup_bench(
+    '-c', "import sys, quicksort, mergesort, leveldb, phdb; assert not {'cv2', 'moviepy', 'imageio'} & set(sys.modules)"))
+bench('startup.cli')(startup_bench('-m', 'dvis', '--help'))
+
+
+def measure(op, repeat=5, min_time=0.2):
+    """Seconds per call of op: min and median over repeat rounds, each
+    round calling op enough times to take at least min_time."""
+    op()  # warm up caches
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for i in range(number):
+            op()
+        elapsed = time.perf_counter() - t
+        if elapsed >= min_time:
+            break
+        number *= 2
+    times = [elapsed / number]
+    for r in range(repeat - 1):
+        t = time.perf_counter()
+        for i in range(number):
+            op()
+        times.append((time.perf_counter() - t) / number)
+    return {'min': min(times), 'median': float(np.median(times)), 'number': number, 'repeat': repeat}
+
+
+def run(out, select=None, repeat=5):
+    results = {}
+    for name, setup in benchmarks.items():
+        if select and not any(s in name for s in select):
+            continue
+        op = setup()
+        items = None
+        if isinstance(op, tuple):
+            op, items = op
+        r = measure(op, repeat)
+        if items:
+            r['items'] = items
+            r['items_per_sec'] = items / r['median']
+        results[name] = r
+        rate = f"  {r['items_per_sec']:.0f}/s" if items else ''
+        print(f"{name:28s} {r['median']*1000:10.3f}ms  (min {r['min']*1000:.3f}ms){rate}")
+    doc = {
+        'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                 'numpy': np.__version__, 'platform': platform.platform(), 'machine': platform.node()},
+        'results': results,
+    }
+    with open(out, 'w') as f:
+        json.dump(doc, f, indent=1)
+    print(f'saved {out}')
+    return doc
+
+
+def compare(base, new, threshold=0.1):
+    """Print the median time ratio new/base of every benchmark and return
+    the names that got slower by more than threshold."""
+    with open(base) as f:
+        b = json.load(f)['results']
+    with open(new) as f:
+        n = json.load(f)['results']
+    regressions = []
+    for name in sorted(set(b) | set(n)):
+        if name not in n or name not in b:
+            print(f"{name:28s} {'only in ' + (base if name in b else new)}")
+            continue
+        ratio = n[name]['median'] / b[name]['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            flag = '  faster'
+        print(f"{name:28s} {b[name]['median']*1000:10.3f}ms -> {n[name]['median']*1000:10.3f}ms  x{ratio:.2f}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='dvis rendering benchmarks')
+    sub = p.add_subparsers(dest='cmd', required=True)
+    r = sub.add_parser('run', help='run benchmarks and save the results as a JSON baseline')
+    r.add_argument('-o', '--out', default='bench.json')
+    r.add_argument('-k', action='append', help='only benchmarks whose name contains this, repeatable')
+    r.add_argument('--repeat', type=int, default=5)
+    c = sub.add_parser('compare', help='compare two JSON results, exit status 1 on regressions')
+    c.add_argument('base')
+    c.add_argument('new')
+    c.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown, default 0.1 (10%%)')
+    a = p.parse_args()
+    if a.cmd == 'run':
+        run(a.out, a.k, a.repeat)
+    elif compare(a.base, a.new, a.threshold):
+        sys.exit(1)
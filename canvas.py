@@ -1,8 +1,9 @@
 from base64 import b64encode
 import numpy as np
 import cairocffi as cairo
-import imageio
 import colors
+import math
+import textcache
 
 try:
     from cStringIO import StringIO
@@ -15,12 +16,22 @@ except ImportError:
 
 
 class Canvas:
-    def __init__(self, width=640, height=480):
+    def __init__(self, width=640, height=480, retained=False):
+        """With `retained` the primitives of a frame (everything drawn after
+        clear()) are recorded instead of painted, and on readback only the
+        rectangles covered by primitives that changed since the previous
+        frame are cleared and repainted. The result is pixel-identical to
+        drawing every primitive."""
         self.width = width
         self.height = height
         self._cairo_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
                                                  width, height)
         self.context = cairo.Context(self._cairo_surface)
+        self._raw = None
+        self.retained = retained
+        self._ops = None  # [(fn, args, matrix, device bbox)] of the frame being drawn
+        self._prev_ops = None  # ops of the frame currently on the surface
+        self.text_cache = textcache.default
 
     @staticmethod
     def from_image(image):
@@ -40,15 +51,41 @@ class Canvas:
         return sf
 
     def write_to_png(self, filename):
+        import imageio
         imageio.imwrite(filename, self.get_npimage(True), format='png')
 
-    def get_npimage(self, transparent=False, y_origin="top"):
-        im = 0 + np.frombuffer(self._cairo_surface.get_data(), np.uint8)
-        im.shape = (self.height, self.width, 4)
-        im = im[:, :, [2, 1, 0, 3]]  # put RGB back in order
+    def flush(self):
+        """Finish all pending drawing: paint the recorded primitives in
+        retained mode and let cairo complete its rendering."""
+        if self._ops is not None:
+            self._commit()
+        self._cairo_surface.flush()
+
+    def _raw_npimage(self):
+        """Return a (height, width, 4) BGRA view over the cairo buffer, no copy."""
+        self.flush()
+        if self._raw is None:
+            raw = np.frombuffer(self._cairo_surface.get_data(), np.uint8)
+            raw = raw.reshape(self.height, self._cairo_surface.get_stride() // 4, 4)
+            self._raw = raw[:, :self.width]
+        return self._raw
+
+    def get_npimage(self, transparent=False, y_origin="top", out=None):
+        """Return the surface as an RGB(A) array.
+
+        If `out` is given (a contiguous uint8 array of shape (h, w, 3) or
+        (h, w, 4)) the pixels are written into it and it is returned, so a
+        caller reading back every frame does not allocate.
+        """
+        raw = self._raw_npimage()
         if y_origin == "bottom":
-            im = im[::-1]
-        return im if transparent else im[:, :, :3]
+            raw = raw[::-1]
+        if out is None:
+            out = np.empty((self.height, self.width, 4 if transparent else 3), np.uint8)
+        out[:, :, :3] = raw[:, :, 2::-1]  # BGR -> RGB
+        if transparent:
+            out[:, :, 3] = raw[:, :, 3]
+        return out
 
     def get_html_embed_code(self, y_origin="top"):
         """Return an html code containing all the PNG data of the surface. """
@@ -80,37 +117,102 @@ class Canvas:
         self.translate(self.width/2, self.height/2)
 
     def _set_source(self, src):
-        if isinstance(src, str):
-            if len(src) == 3:
-                src = (int(src[0], 16)/15, int(src[1], 16)/15, int(src[2], 16)/15)
-            elif len(src) == 4:
-                src = (int(src[0], 16)/15, int(src[1], 16)/15, int(src[2], 16)/15, int(src[3], 16)/15)
-            elif len(src) == 6:
-                src = (int(src[0:2], 16)/255, int(src[2:4], 16)/255, int(src[4:6], 16)/255)
-            elif len(src) == 8:
-                src = (int(src[0:2], 16)/255, int(src[2:4], 16)/255, int(src[4:6], 16)/255, int(src[6:8], 16)/255)
-        elif isinstance(src, int) and src < 0xffffff:
-            src = ((src & 0xff0000) >> 16) / 255.0, ((src & 0xff00) >> 8) / 255.0, (src & 0xff) / 255.0
-        if len(src) == 4:
-            self.context.set_source_rgba(*src)
-        elif len(src) == 3:
-            self.context.set_source_rgb(*src)
+        self.context.set_source(colors.pattern(src))
+
+    def _device_bbox(self, m, x, y, w, h):
+        """Pixel-aligned device space bbox of a user space rectangle, padded
+        for antialiasing and clamped to the surface: (x0, y0, x1, y1)."""
+        xx, yx, xy, yy, x0, y0 = m
+        if xx == 1 and yy == 1 and xy == 0 and yx == 0:
+            xs = (x + x0, x + w + x0)
+            ys = (y + y0, y + h + y0)
         else:
-            raise Exception(f'bad color format: {src}')
+            xs = [xx * px + xy * py + x0 for px in (x, x + w) for py in (y, y + h)]
+            ys = [yx * px + yy * py + y0 for px in (x, x + w) for py in (y, y + h)]
+        return (max(0, math.floor(min(xs)) - 1), max(0, math.floor(min(ys)) - 1),
+                min(self.width, math.ceil(max(xs)) + 1), min(self.height, math.ceil(max(ys)) + 1))
 
-    def clear(self, color=colors.White):
-        self.context.identity_matrix()
+    def _record(self, fn, args, bbox=None):
+        """Record a primitive of the current frame, bbox None covers the whole surface."""
+        if self._ops is None:
+            # drawing on top of a committed frame without clear()
+            self._ops = list(self._prev_ops or [])
+        m = self.context.get_matrix().as_tuple()
+        if bbox is None:
+            dbbox = (0, 0, self.width, self.height)
+        else:
+            dbbox = self._device_bbox(m, *bbox)
+        self._ops.append((fn, args, m, dbbox))
+
+    def _commit(self):
+        """Paint the recorded frame over the previous one, only where it differs."""
+        ops, prev = self._ops, self._prev_ops
+        self._ops = None
+        self._prev_ops = ops
+        full = (0, 0, self.width, self.height)
+        if prev is None:
+            dirty = [full]
+        else:
+            dirty = []
+            n = min(len(ops), len(prev))
+            for i in range(n):
+                if ops[i][:3] != prev[i][:3]:
+                    dirty.append(prev[i][3])
+                    dirty.append(ops[i][3])
+            dirty.extend(e[3] for e in ops[n:])
+            dirty.extend(e[3] for e in prev[n:])
+            if len(dirty) == 0:
+                return
+        area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in dirty)
+        ctx = self.context
+        ctx.save()
+        # dirty rectangles are in device pixels, whatever render() left
+        # translated must not move the clip
+        ctx.identity_matrix()
+        if area < self.width * self.height // 2:
+            for x0, y0, x1, y1 in dirty:
+                ctx.rectangle(x0, y0, x1 - x0, y1 - y0)
+            ctx.clip()
+        else:
+            dirty = [full]
+        for fn, args, m, (bx0, by0, bx1, by1) in ops:
+            for x0, y0, x1, y1 in dirty:
+                if bx0 < x1 and x0 < bx1 and by0 < y1 and y0 < by1:
+                    ctx.set_matrix(cairo.Matrix(*m))
+                    fn(self, *args)
+                    break
+        ctx.restore()
+
+    def _clear(self, color):
         self.context.rectangle(0, 0, self.width, self.height)
         self._set_source(color)
         self.context.fill()
 
-    def line(self, p0, p1, color=colors.Black, width=2):
+    def clear(self, color=colors.White):
+        self.context.identity_matrix()
+        if self.retained:
+            # start of a new frame
+            self._ops = []
+            self._record(Canvas._clear, (color,))
+        else:
+            self._clear(color)
+
+    def _line(self, p0, p1, color, width):
         self.context.move_to(*p0)
         self.context.line_to(*p1)
         self.context.set_line_width(width)
         self._set_source(color)
         self.context.stroke()
 
+    def line(self, p0, p1, color=colors.Black, width=2):
+        if self.retained:
+            x0, x1 = min(p0[0], p1[0]), max(p0[0], p1[0])
+            y0, y1 = min(p0[1], p1[1]), max(p0[1], p1[1])
+            b = width / 2
+            self._record(Canvas._line, (tuple(p0), tuple(p1), color, width), (x0-b, y0-b, x1-x0+width, y1-y0+width))
+        else:
+            self._line(p0, p1, color, width)
+
     def draw_axis(self, x=-1, y=-1):
         if x == -1:
             x = self.width / 2
@@ -119,11 +221,19 @@ class Canvas:
         self.line((0, y), (self.width, y))
         self.line((x, 0), (x, self.height))
 
-    def draw(self, e):
+    def _draw(self, e, token=None):
         self.context.save()
         e.draw(self.context)
         self.context.restore()
 
+    def draw(self, e):
+        if self.retained:
+            # unknown extent and the element may have changed in place,
+            # a fresh token makes it always dirty
+            self._record(Canvas._draw, (e, object()))
+        else:
+            self._draw(e)
+
     def _draw_path(self, color=None, border=0, border_color=colors.Black):
         if color:
             self._set_source(color)
@@ -136,25 +246,96 @@ class Canvas:
             self._set_source(border_color)
             self.context.stroke()
 
-    def box(self, x, y, w, h, color=colors.White, border=2, border_color=colors.Black):
+    def _box(self, x, y, w, h, color, border, border_color):
         self.context.rectangle(x, y, w, h)
         self._draw_path(color, border, border_color)
+
+    def box(self, x, y, w, h, color=colors.White, border=2, border_color=colors.Black):
+        if self.retained:
+            b = border / 2
+            self._record(Canvas._box, (x, y, w, h, color, border, border_color), (x-b, y-b, w+border, h+border))
+        else:
+            self._box(x, y, w, h, color, border, border_color)
         return (x, y, w, h)
 
-    def circle(self, x, y, r, fill=colors.White, border=2, border_color=colors.Black):
+    def _group_rects(self, rects, color, palette):
+        """Split (n, 4) rects into [(color, [rect, ...])] by color, which is a
+        single color or an array of indices into palette."""
+        if not isinstance(color, np.ndarray):
+            return [(color, rects.tolist())]
+        idx = np.broadcast_to(color, (len(rects),))
+        order = np.argsort(idx, kind='stable')
+        sidx = idx[order]
+        rl = rects[order].tolist()
+        starts = np.flatnonzero(np.r_[True, sidx[1:] != sidx[:-1]]).tolist()
+        groups = []
+        for s, e in zip(starts, starts[1:] + [len(rl)]):
+            c = int(sidx[s])
+            c = palette.pattern(c) if isinstance(palette, colors.Palette) else palette[c]
+            groups.append((c, rl[s:e]))
+        return groups
+
+    def _boxes(self, fills, strokes, border):
+        ctx = self.context
+        for color, rects in fills:
+            for r in rects:
+                ctx.rectangle(*r)
+            self._set_source(color)
+            ctx.fill()
+        if len(strokes) > 0:
+            ctx.set_line_width(border)
+            for color, rects in strokes:
+                for r in rects:
+                    ctx.rectangle(*r)
+                self._set_source(color)
+                ctx.stroke()
+
+    def boxes(self, x, y, w, h, color=colors.White, border=2, border_color=colors.Black, palette=None):
+        """Draw many boxes with one fill / stroke per distinct color.
+
+        x, y, w, h are arrays or scalars broadcast against each other, color
+        and border_color are either one color or int arrays of indices into
+        palette (a Palette or a list of colors). All fills are painted before
+        all borders, so unlike a loop over box() overlapping boxes are not
+        layered in order. Returns the bbox of all boxes.
+        """
+        x, y, w, h = np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in (x, y, w, h)))
+        rects = np.stack([x.ravel(), y.ravel(), w.ravel(), h.ravel()], axis=1)
+        if len(rects) == 0:
+            return None
+        fills = self._group_rects(rects, color, palette) if color is not None else []
+        strokes = self._group_rects(rects, border_color, palette) if border > 0 else []
+        x0 = float(np.minimum(x, x + w).min())
+        y0 = float(np.minimum(y, y + h).min())
+        bbox = (x0, y0, float(np.maximum(x, x + w).max()) - x0, float(np.maximum(y, y + h).max()) - y0)
+        if self.retained:
+            b = border / 2
+            self._record(Canvas._boxes, (fills, strokes, border), (bbox[0]-b, bbox[1]-b, bbox[2]+border, bbox[3]+border))
+        else:
+            self._boxes(fills, strokes, border)
+        return bbox
+
+    def _circle(self, x, y, r, fill, border, border_color):
         self.context.move_to(x + r, y)
-        self.context.arc(x, y, self.r, 0, 2 * np.pi)
+        self.context.arc(x, y, r, 0, 2 * np.pi)
         self._draw_path(fill, border, border_color)
+
+    def circle(self, x, y, r, fill=colors.White, border=2, border_color=colors.Black):
+        if self.retained:
+            b = r + border / 2
+            self._record(Canvas._circle, (x, y, r, fill, border, border_color), (x-b, y-b, b*2, b*2))
+        else:
+            self._circle(x, y, r, fill, border, border_color)
         return (x-r, y-r, x+r*2, y+r*2)
 
     def text(self, x, y, text, fontsize=24, align='center', color=colors.Black):
-        self.context.set_font_size(fontsize)
         if text is None:
             return
         text = str(text)
         if len(text) == 0:
             return
-        xbear, ybear, w, h, xadvance, yadvance = self.context.text_extents(text)
+        extents = self.text_cache.get(self.context, '', fontsize, text)[0]
+        xbear, ybear, w, h, xadvance, yadvance = extents
         if align == 'center':
             x = x - w / 2 - xbear
             y = y - h / 2 - ybear
@@ -170,11 +351,16 @@ class Canvas:
         elif align == 'bottom':
             x = x - w / 2 - xbear
             y = y - h - ybear
-        self.context.move_to(x, y)
-        self.context.text_path(text)
-        self._draw_path(color, 0)
+        if self.retained:
+            self._record(Canvas._text, (x, y, text, fontsize, color), (x+xbear, y+ybear, w, h))
+        else:
+            self._text(x, y, text, fontsize, color)
         return (x, y, w, h)
 
+    def _text(self, x, y, text, fontsize, color):
+        self.text_cache.glyph_path(self.context, x, y, self.text_cache.get(self.context, '', fontsize, text))
+        self._draw_path(color, 0)
+
     def text_box(self, x, y, w, h, text, text_size=None, text_color=colors.Black, box_color=colors.White, border=2, border_color=colors.Black):
         ret = self.box(x, y, w, h, color=box_color, border = border, border_color=border_color)
         if text is not None:
@@ -208,6 +394,9 @@ class Canvas:
             return (x, y, w*len(texts), h)
 
     def box_matrix(self, x, y, w, h, matrix, text_size=None, text_color=colors.Black, box_color=colors.White, border=2, border_color=colors.Black):
+        if isinstance(matrix, np.ndarray) and isinstance(box_color, colors.Palette):
+            return self.heatmap(x, y, w, h, matrix, box_color, text_size=text_size, text_color=text_color,
+                                border=border, border_color=border_color)
         for j, row in enumerate(matrix):
             for i, e in enumerate(row):
                 tcolor = text_color
@@ -224,6 +413,73 @@ class Canvas:
                               border_color=border_color)
         return (x, y, w*len(matrix[0]), h*len(matrix))
 
+    @staticmethod
+    def _palette_index(matrix, n, vmin, vmax):
+        if vmin is None and vmax is None and np.issubdtype(matrix.dtype, np.integer):
+            return matrix % n
+        vmin = matrix.min() if vmin is None else vmin
+        vmax = matrix.max() if vmax is None else vmax
+        scale = n / (vmax - vmin) if vmax > vmin else 0
+        return np.clip(((matrix - vmin) * scale).astype(np.intp), 0, n - 1)
+
+    def _raster(self, token, x, y, w, h, idx, palette):
+        """Write the cells straight into the surface buffer, cell edges
+        rounded to whole pixels, translation-only CTM."""
+        lut = np.zeros((len(palette), 4), np.uint8)
+        for i in range(len(palette)):
+            c = colors.parse(palette[i])
+            a = c[3] if len(c) == 4 else 1.0
+            # cairo stores premultiplied BGRA
+            lut[i] = np.rint(np.array([c[2] * a, c[1] * a, c[0] * a, a]) * 255)
+        tx, ty = self.context.get_matrix().as_tuple()[4:]
+        nrow, ncol = idx.shape
+        xe = np.clip(np.rint(tx + x + np.arange(ncol + 1) * w).astype(np.intp), 0, self.width)
+        ye = np.clip(np.rint(ty + y + np.arange(nrow + 1) * h).astype(np.intp), 0, self.height)
+        cols = np.repeat(np.arange(ncol), np.diff(xe))
+        rows = np.repeat(np.arange(nrow), np.diff(ye))
+        if len(cols) == 0 or len(rows) == 0:
+            return
+        raw = self._raw_npimage()
+        raw[ye[0]:ye[-1], xe[0]:xe[-1]] = lut[idx[rows[:, None], cols]]
+        self._cairo_surface.mark_dirty()
+
+    def heatmap(self, x, y, w, h, matrix, palette=colors.Sequential, vmin=None, vmax=None, text_size=None,
+                text_color=colors.Black, border=2, border_color=colors.Black, fmt='{:g}', min_border_cell=4,
+                min_text_cell=10):
+        """Draw a 2-D array as a grid of w x h cells colored from palette.
+
+        Integer arrays without vmin/vmax index the palette directly, anything
+        else is mapped linearly from [vmin, vmax] (default the array range)
+        onto it. Cells are written directly into the surface buffer, so the
+        cost is bounded by the pixels covered rather than the number of cells.
+        Borders are only drawn when cells are at least min_border_cell pixels
+        and values as text when they are at least min_text_cell pixels.
+        """
+        matrix = np.asarray(matrix)
+        nrow, ncol = matrix.shape
+        idx = self._palette_index(matrix, len(palette), vmin, vmax)
+        bbox = (x, y, w*ncol, h*nrow)
+        if self.context.get_matrix().as_tuple()[:4] != (1, 0, 0, 1):
+            # scaled or rotated, fall back to batched boxes
+            cx, cy = np.meshgrid(x + np.arange(ncol) * w, y + np.arange(nrow) * h)
+            self.boxes(cx, cy, w, h, idx.ravel(), 0, palette=palette)
+        elif self.retained:
+            # the fresh token comes first so comparing recorded ops stops
+            # at it and never reaches the idx array
+            self._record(Canvas._raster, (object(), x, y, w, h, idx, palette), bbox)
+        else:
+            self._raster(None, x, y, w, h, idx, palette)
+        if border > 0 and min(w, h) >= min_border_cell:
+            for j in range(nrow + 1):
+                self.line((x, y+j*h), (x+w*ncol, y+j*h), border_color, border)
+            for i in range(ncol + 1):
+                self.line((x+i*w, y), (x+i*w, y+h*nrow), border_color, border)
+        if min(w, h) >= min_text_cell:
+            for j in range(nrow):
+                for i in range(ncol):
+                    self.text(x+i*w+w/2, y+j*h+h/2, fmt.format(matrix[j, i]), text_size or h-2, color=text_color)
+        return bbox
+
     def text_align_to(self, bbox, text, fontsize=24, align='top', color=colors.Black, padding=4):
         x, y, w, h = bbox
         if align == 'left':
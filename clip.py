@@ -1,60 +1,524 @@
+import os
+import pickle
+import cProfile
+import pstats
+import queue
+import shutil
+import sys
+import subprocess
+import tempfile
+import threading
+import zlib
+import time
+import multiprocessing
+from collections import deque
+import numpy as np
 from canvas import Canvas
-from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
-import cv2
+from timing import Timings
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+# filename that selects NullWriter
+NULL = 'null'
+
+
+def same_frame(a, b):
+    """Exact comparison of two frames, on 8-byte words when the size allows."""
+    if a.nbytes % 8 == 0:
+        a = a.reshape(-1).view(np.uint64)
+        b = b.reshape(-1).view(np.uint64)
+    return np.array_equal(a, b)
+
+
+_worker_clip = None
+
+
+def _init_render_worker(data):
+    global _worker_clip
+    clip = pickle.loads(data)
+    width, height, retained = clip.canvas
+    clip.canvas = Canvas(width, height, retained=retained)
+    _worker_clip = clip
+
+
+def _render_snapshot(snapshot):
+    """Render one frame in a worker, returns it with [(phase, seconds)] of
+    the phases Clip._step would time, empty unless the clip times them."""
+    clip = _worker_clip
+    clip.__dict__.update(pickle.loads(snapshot))
+    laps = []
+    t = time.perf_counter()
+    clip.render()
+    if clip.canvas.retained:
+        laps.append(('render', time.perf_counter() - t))
+        t = time.perf_counter()
+        clip.canvas.flush()
+        laps.append(('rasterize', time.perf_counter() - t))
+    else:
+        clip.canvas.flush()
+        laps.append(('render', time.perf_counter() - t))
+    t = time.perf_counter()
+    frame = clip.canvas.get_npimage()
+    laps.append(('readback', time.perf_counter() - t))
+    return frame, laps if clip.timing else []
+
+
+class VFRWriter:
+    """Variable frame rate writer: every distinct frame is stored once
+    together with how long it is shown, and ffmpeg's concat demuxer builds
+    the video from that list on close(). A hold costs one frame however
+    long it is, and the result plays the same as repeating the frame."""
+
+    def __init__(self, filename, size, fps):
+        self.filename = filename
+        self.size = size
+        self.fps = fps
+        self.dir = tempfile.mkdtemp(prefix='dvis-')
+        self.frames = []  # (png path, nframe)
+
+    def write_frame(self, frame, nframe=1):
+        path = os.path.join(self.dir, f'{len(self.frames):08d}.png')
+        import imageio
+        imageio.imwrite(path, frame, format='png')
+        self.frames.append((path, nframe))
+
+    def close(self):
+        try:
+            if len(self.frames) == 0:
+                return
+            list_path = os.path.join(self.dir, 'frames.txt')
+            with open(list_path, 'w') as f:
+                for path, nframe in self.frames:
+                    f.write(f"file '{path}'\nduration {nframe / self.fps:.6f}\n")
+                # concat demuxer ignores the duration of the last entry unless it is repeated
+                f.write(f"file '{self.frames[-1][0]}'\n")
+            import imageio_ffmpeg
+            cmd = [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error',
+                   '-f', 'concat', '-safe', '0', '-i', list_path,
+                   '-vsync', 'vfr', '-vcodec', 'libx264', '-pix_fmt', 'yuv420p',
+                   self.filename]
+            subprocess.run(cmd, check=True)
+        finally:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class NullWriter:
+    """Discards every frame, for measuring render throughput: frames still
+    go through render, readback and duplicate detection, but nothing is
+    shown or encoded."""
+
+    def write_frame(self, frame, nframe=1):
+        pass
+
+    def close(self):
+        pass
+
+
+class FrameHistory:
+    """The most recent frames within a byte budget, the oldest dropped
+    first, for scrubbing back and forth in preview. Frames are stored as
+    copies or compressed with 'zlib', 'png' (lossless, via OpenCV) or 'lz4'
+    (needs the lz4 package); at least the newest frame is always kept."""
+
+    def __init__(self, budget, compress=None):
+        if compress == 'lz4':
+            try:
+                import lz4.frame
+            except ImportError:
+                raise Exception('lz4 frame history needs the lz4 package')
+            self.lz4 = lz4.frame
+        elif compress not in (None, 'zlib', 'png'):
+            raise Exception(f'unknown frame history compression: {compress}')
+        self.budget = budget
+        self.compress = compress
+        self.frames = deque()  # encoded frames, oldest first
+        self.nbytes = 0
+        self.shape = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def append(self, frame):
+        self.shape = frame.shape
+        if self.compress is None:
+            data = frame.copy()
+        elif self.compress == 'png':
+            import cv2
+            data = cv2.imencode('.png', frame)[1]
+        elif self.compress == 'zlib':
+            data = zlib.compress(frame, 1)
+        else:
+            data = self.lz4.compress(frame)
+        self.frames.append(data)
+        self.nbytes += len(data) if isinstance(data, bytes) else data.nbytes
+        while self.nbytes > self.budget and len(self.frames) > 1:
+            data = self.frames.popleft()
+            self.nbytes -= len(data) if isinstance(data, bytes) else data.nbytes
+
+    def __getitem__(self, i):
+        data = self.frames[i]
+        if self.compress is None:
+            return data
+        if self.compress == 'png':
+            import cv2
+            return cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+        if self.compress == 'zlib':
+            data = zlib.decompress(data)
+        else:
+            data = self.lz4.decompress(data)
+        return np.frombuffer(data, np.uint8).reshape(self.shape)
+
+
+def peak_memory():
+    """Peak resident set size in bytes of this process and of its finished
+    children (render workers), None where the resource module is missing."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * unit
 
 
 class Clip:
-    def __init__(self, w, h, filename, fps):
+    # attributes render() reads, snapshotted on every step when rendering
+    # in worker processes; None means the clip only renders serially
+    state_attrs = None
+
+    def __init__(self, w, h, filename, fps, pipeline=0, vfr=False, workers=0, retained=False,
+                 timing=False, profile=0, profile_every=10, history=256 << 20, history_compress=None):
+        """`pipeline` > 0 encodes on a background thread, with at most that
+        many rendered frames queued ahead of ffmpeg. `vfr` writes holds as
+        frame durations instead of repeated frames, see VFRWriter; only
+        then (or with NULL) are frames identical to the previous one
+        detected and turned into holds.
+        `workers` > 0 renders frames from state_attrs snapshots in that many
+        processes. `retained` only repaints what changed between frames,
+        see Canvas. A filename of NULL ('null') discards frames and reports
+        throughput on finish(), see NullWriter.
+        `timing` keeps per frame histograms of the time spent in each phase
+        (render, readback, compare, write, ...) and prints them on finish();
+        cairo draws while render() runs so render includes rasterization,
+        except in retained mode where painting is timed as rasterize. With
+        `workers` those phases are timed in the worker processes and
+        'worker' is the wait for each finished frame. A
+        `timing` path also saves them there, as Prometheus text for .prom
+        and JSON otherwise. `profile` > 0 runs that many steps, one every
+        profile_every, under cProfile and saves the stats to <filename>.prof.
+        In preview (no filename) up to `history` bytes of recent frames are
+        kept, compressed with history_compress, see FrameHistory, so 'b'
+        steps back through them and any other key forward again; past the
+        oldest kept frame 'b' falls back to on_step_back()."""
         self.fps = fps
         self.nframe = 0
-        self.canvas = Canvas(w, h)
+        self.canvas = Canvas(w, h, retained=retained)
         if filename is None or filename == '':
             self.writer = None
+        elif filename == NULL:
+            self.writer = NullWriter()
+        elif vfr:
+            self.writer = VFRWriter(filename, (w,h), fps)
         else:
+            # video, preview and image backends are imported on first use,
+            # they take seconds to import
+            from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
             self.writer = FFMPEG_VideoWriter(filename, (w,h), fps=fps)
         self.last_frame = self.canvas.get_npimage()
-    
+        self.next_frame = np.empty_like(self.last_frame)
+        # only writers taking a duration per frame gain from turning repeats
+        # into holds, the ffmpeg writer encodes a held frame every time anyway
+        self.dedup = isinstance(self.writer, (VFRWriter, NullWriter))
+        self.dup_frames = 0
+        # number of times last_frame still has to be written, frames are
+        # handed to the writer lazily so a hold is a single write request
+        self.hold = 0
+        self.queue = None
+        if self.writer and pipeline > 0:
+            self._start_pipeline(pipeline)
+        self.workers = workers if self.writer else 0
+        self.pool = None
+        self.pending = deque()  # ('frame', AsyncResult) or ('wait', nframe), in output order
+        # seconds spent in each step(), only kept for the null writer
+        self.step_times = [] if isinstance(self.writer, NullWriter) else None
+        self.start_time = None
+        self.nstep = 0
+        self.timing = timing
+        self.timings = Timings() if timing else None
+        self.profile = profile
+        self.profile_every = profile_every
+        self.profiler = cProfile.Profile() if profile > 0 else None
+        self.profile_path = (filename if self.writer and filename != NULL else type(self).__name__) + '.prof'
+        self.history = FrameHistory(history, history_compress) if self.writer is None and history > 0 else None
+
+    def __getstate__(self):
+        # what a render worker needs: everything but the output side
+        state = self.__dict__.copy()
+        for k in ('writer', 'queue', 'free_frames', 'writer_thread', 'writer_error',
+                  'pool', 'pending', 'last_frame', 'next_frame', 'step_times', 'timings', 'profiler',
+                  'history'):
+            state.pop(k, None)
+        state['canvas'] = (self.canvas.width, self.canvas.height, self.canvas.retained)
+        return state
+
+    def snapshot(self):
+        """Freeze the render state, pickled right away so later in place
+        mutation by the simulation can not leak into a queued frame."""
+        return pickle.dumps({k: getattr(self, k) for k in self.state_attrs}, pickle.HIGHEST_PROTOCOL)
+
+    def _submit_render(self):
+        if self.pool is None:
+            if self.state_attrs is None:
+                raise Exception(f'{type(self).__name__} does not define state_attrs, can not render in workers')
+            self.pool = multiprocessing.Pool(self.workers, initializer=_init_render_worker,
+                                             initargs=(pickle.dumps(self),))
+        t = time.perf_counter()
+        self.pending.append(('frame', self.pool.apply_async(_render_snapshot, (self.snapshot(),))))
+        self._lap('submit', t)
+        self._drain(self.workers * 2)
+
+    def _drain(self, limit):
+        # hand finished frames to the writer in order, keeping at most limit in flight
+        while len(self.pending) > limit:
+            kind, v = self.pending.popleft()
+            if kind == 'wait':
+                self.hold += v
+            else:
+                t = time.perf_counter()
+                frame, laps = v.get()
+                self._lap('worker', t)
+                np.copyto(self.next_frame, frame)
+                for phase, sec in laps:
+                    self.timings.add(phase, sec)
+                self._push_frame()
+
+    def _start_pipeline(self, depth):
+        self.queue = queue.Queue(depth)
+        # depth queued + 1 being encoded, last_frame and next_frame are extra
+        self.free_frames = queue.Queue()
+        for i in range(depth + 1):
+            self.free_frames.put(np.empty_like(self.last_frame))
+        self.writer_error = None
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def _write_loop(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                frame, n = item
+                self._write_frame(frame, n)
+                self.free_frames.put(frame)
+        except BaseException as e:
+            self.writer_error = e
+
+    def _write_frame(self, frame, n):
+        t = time.perf_counter()
+        if isinstance(self.writer, (VFRWriter, NullWriter)):
+            self.writer.write_frame(frame, n)
+        else:
+            for i in range(n):
+                self.writer.write_frame(frame)
+        self._lap('write', t)
+
+    def _lap(self, phase, t):
+        """Record the time since t for phase, returns the current time."""
+        if self.timings is None:
+            return t
+        now = time.perf_counter()
+        self.timings.add(phase, now - t)
+        return now
+
+    def _check_writer(self):
+        if self.writer_error is not None:
+            raise Exception('background writer failed') from self.writer_error
+
+    def _blocking(self, op, *args):
+        # poll so an error in the writer thread can not leave us blocked forever
+        while True:
+            self._check_writer()
+            try:
+                return op(*args, timeout=0.1)
+            except (queue.Empty, queue.Full):
+                pass
+
+    def _flush_hold(self):
+        if self.hold == 0:
+            return
+        if self.queue is not None:
+            t = time.perf_counter()
+            self._blocking(self.queue.put, (self.last_frame, self.hold))
+            self._lap('queue', t)
+        else:
+            self._write_frame(self.last_frame, self.hold)
+        self.hold = 0
+
     def step(self):
-        self.render()
-        frame = self.canvas.get_npimage()
-        self.last_frame = frame
+        t = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = t
+        if self.profiler is not None and self.nstep % self.profile_every == 0 and self.nstep // self.profile_every < self.profile:
+            self.profiler.runcall(self._step)
+        else:
+            self._step()
+        self.nstep += 1
+        if self.step_times is not None:
+            self.step_times.append(time.perf_counter() - t)
+
+    def _step(self):
         self.nframe += 1
-        if self.writer:
-            self.writer.write_frame(frame)
+        if self.workers > 0:
+            self._submit_render()
+            return
+        t = time.perf_counter()
+        self.render()
+        if self.canvas.retained:
+            # render() only recorded primitives, painting happens here
+            t = self._lap('render', t)
+            self.canvas.flush()
+            t = self._lap('rasterize', t)
         else:
+            # cairo draws immediately, its cost can not be told apart from render()
+            self.canvas.flush()
+            t = self._lap('render', t)
+        # read back into a preallocated buffer, no per-frame allocation
+        frame = self.canvas.get_npimage(out=self.next_frame)
+        self._lap('readback', t)
+        if self.writer is None:
+            self.next_frame, self.last_frame = self.last_frame, frame
+            if self.history is not None:
+                self.history.append(frame)
             self._cv_show_wait()
+            return
+        self._push_frame()
+
+    def _push_frame(self):
+        frame = self.next_frame
+        if self.dedup and self.hold > 0:
+            t = time.perf_counter()
+            same = same_frame(frame, self.last_frame)
+            self._lap('compare', t)
+        else:
+            same = False
+        if same:
+            # unchanged frame, extend the hold instead of encoding it again
+            self.hold += 1
+            self.dup_frames += 1
+            return
+        self._flush_hold()
+        if self.queue is not None:
+            # last_frame is owned by the writer thread until it is recycled
+            t = time.perf_counter()
+            self.next_frame = self._blocking(self.free_frames.get)
+            self._lap('queue', t)
+        else:
+            self.next_frame = self.last_frame
+        self.last_frame = frame
+        self.hold = 1
 
     def on_step_back(self):
         pass
 
+    def replay(self, trace, start=0, stop=None):
+        """Render steps [start, stop) of an EventTrace recorded from this
+        clip's state_attrs, one step() each."""
+        for i, state in trace.replay(start, stop):
+            self.__dict__.update(state)
+            self.step()
+
     def wait(self, sec):
-        nframe = max(1, int(self.fps * sec))
+        self.hold_frames(max(1, int(self.fps * sec)))
+
+    def hold_frames(self, nframe):
+        """Keep showing the last frame for nframe more frames."""
         self.nframe += nframe
-        if self.writer:
-            for i in range(nframe):
-                self.writer.write_frame(self.last_frame)
+        if self.pending:
+            self.pending.append(('wait', nframe))
+        elif self.writer:
+            self.hold += nframe
         else:
-            self.nframe += nframe
             self._cv_show_wait()
 
     def _cv_show_wait(self):
-        cvt = cv2.cvtColor(self.last_frame, cv2.COLOR_BGR2RGB)
-        cv2.imshow('preview', cvt)
-        key = cv2.waitKey(0)
-        if key == ord('q') or key == 27:  # Esc
-            cv2.destroyAllWindows()
-            raise Exception('preview stopped')
-        elif key == ord('b'):
-            # default do not support step back
-            self.on_step_back()
+        import cv2
+        n = len(self.history) if self.history is not None else 0
+        pos = n - 1  # shown history frame, the newest is last_frame
+        frame = self.last_frame
+        while True:
+            cvt = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            cv2.imshow('preview', cvt)
+            key = cv2.waitKey(0)
+            if key == ord('q') or key == 27:  # Esc
+                cv2.destroyAllWindows()
+                raise Exception('preview stopped')
+            elif key == ord('b'):
+                if pos <= 0:
+                    # out of history, default do not support step back
+                    self.on_step_back()
+                    return
+                pos -= 1
+            elif pos >= n - 1:
+                return
+            else:
+                pos += 1
+            frame = self.history[pos]
 
     def finish(self):
         if self.writer:
-            self.writer.close()
+            try:
+                if self.pool is not None:
+                    self._drain(0)
+                    self.pool.close()
+                    self.pool.join()
+                self._flush_hold()
+                if self.queue is not None:
+                    self._blocking(self.queue.put, None)
+                    self.writer_thread.join()
+                    self._check_writer()
+            finally:
+                self.writer.close()
+            if self.dup_frames > 0:
+                print(f'duplicate frames held: {self.dup_frames}/{self.nframe}')
+            if self.step_times is not None:
+                self.print_throughput()
         else:
+            import cv2
             cv2.destroyAllWindows()
+        if self.timings is not None:
+            print(self.timings.format())
+            if not self.canvas.retained and 'render' in self.timings.phases:
+                print('render includes cairo rasterization, only retained mode times it apart')
+            if isinstance(self.timing, str):
+                self.timings.save(self.timing)
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_path)
+            print(f'profile of {min(self.profile, -(-self.nstep // self.profile_every))} steps saved to {self.profile_path}')
+            pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(15)
 
-    def render(self):
-        self.canvas.clear()
+    def throughput(self):
+        """Render throughput so far with the null writer: rendered frames,
+        wall seconds from the first step, frames/s, step latency percentiles
+        in seconds and peak memory in bytes."""
+        n = len(self.step_times)
+        elapsed = time.perf_counter() - self.start_time if n > 0 else 0.0
+        ret = {'frames': n, 'seconds': elapsed, 'fps': n / elapsed if elapsed > 0 else 0.0}
+        if n > 0:
+            p = np.percentile(self.step_times, [50, 90, 99, 100])
+            ret.update(p50=p[0], p90=p[1], p99=p[2], max=p[3])
+        ret['peak_memory'] = peak_memory()
+        return ret
 
+    def print_throughput(self):
+        t = self.throughput()
+        ret = f"{t['frames']} frames in {t['seconds']:.2f}s, {t['fps']:.1f} frames/s"
+        if t['frames'] > 0:
+            ret += ', latency ms ' + ' '.join(f'{k}:{t[k]*1000:.2f}' for k in ('p50', 'p90', 'p99', 'max'))
+        if t['peak_memory'] is not None:
+            ret += f", peak memory {t['peak_memory']/(1 << 20):.1f}MB"
+        print(ret)
 
+    def render(self):
+        self.canvas.clear()
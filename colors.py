@@ -1,3 +1,5 @@
+from collections import OrderedDict
+import cairocffi as cairo
 
 Black = (0,0,0)
 White = (1,1,1)
@@ -6,9 +8,55 @@ Green = (0,1,0)
 Blue = (0,0,1)
 
 
+def parse(src):
+    """Return the (r, g, b) or (r, g, b, a) floats of a color given as a hex
+    string ('777', '0000', 'ff7777', 'ff777780'), a 0xrrggbb int or a tuple."""
+    if isinstance(src, str):
+        if len(src) == 3:
+            return (int(src[0], 16)/15, int(src[1], 16)/15, int(src[2], 16)/15)
+        elif len(src) == 4:
+            return (int(src[0], 16)/15, int(src[1], 16)/15, int(src[2], 16)/15, int(src[3], 16)/15)
+        elif len(src) == 6:
+            return (int(src[0:2], 16)/255, int(src[2:4], 16)/255, int(src[4:6], 16)/255)
+        elif len(src) == 8:
+            return (int(src[0:2], 16)/255, int(src[2:4], 16)/255, int(src[4:6], 16)/255, int(src[6:8], 16)/255)
+    elif isinstance(src, int):
+        if src <= 0xffffff:
+            return ((src & 0xff0000) >> 16) / 255.0, ((src & 0xff00) >> 8) / 255.0, (src & 0xff) / 255.0
+    elif len(src) == 3 or len(src) == 4:
+        return tuple(src)
+    raise Exception(f'bad color format: {src}')
+
+
+# LRU of patterns by color value, bounded since clips may compute a fresh
+# color (e.g. a float shade) on every frame
+_patterns = OrderedDict()
+pattern_cache_size = 1024
+
+
+def pattern(src):
+    """Return a cached cairo source pattern for any color parse() accepts,
+    cairo patterns are passed through."""
+    if isinstance(src, cairo.Pattern):
+        return src
+    try:
+        p = _patterns.get(src)
+    except TypeError:
+        # unhashable, e.g. a list
+        return cairo.SolidPattern(*parse(src))
+    if p is not None:
+        _patterns.move_to_end(src)
+        return p
+    p = _patterns[src] = cairo.SolidPattern(*parse(src))
+    if len(_patterns) > pattern_cache_size:
+        _patterns.popitem(last=False)
+    return p
+
+
 class Palette:
     def __init__(self, colors):
         self.colors = colors
+        self.patterns = None
 
     def __len__(self):
         return len(self.colors)
@@ -19,6 +67,12 @@ class Palette:
             return self.colors[item % l]
         return self.colors[item]
 
+    def pattern(self, item):
+        """Prebuilt cairo pattern of a color, indexed like __getitem__."""
+        if self.patterns is None:
+            self.patterns = [pattern(c) for c in self.colors]
+        return self.patterns[item % len(self.patterns)]
+
 
 Accent = Palette((
     (0.49803921568627452, 0.78823529411764703, 0.49803921568627452),
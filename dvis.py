@@ -1,8 +1,10 @@
+import sys
+import importlib
 from copy import copy, deepcopy
 from base64 import b64encode
 import numpy as np
 import cairocffi as cairo
-import imageio
+import textcache
 
 try:
     from cStringIO import StringIO
@@ -37,6 +39,7 @@ class Surface:
         self._cairo_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
                                                  width, height)
         self.context = cairo.Context(self._cairo_surface)
+        self._raw = None
 
     @staticmethod
     def from_image(image):
@@ -61,9 +64,10 @@ class Surface:
         Parameter y_origin ("top" or "bottom") decides whether point (0,0)
         lies in the top-left or bottom-left corner of the screen.
         """
+        import imageio
         imageio.imwrite(filename, self.get_npimage(True), format='png')
 
-    def get_npimage(self, transparent=False, y_origin="top"):
+    def get_npimage(self, transparent=False, y_origin="top", out=None):
         """ Returns a WxHx[3-4] numpy array representing the RGB picture.
 
         If `transparent` is True the image is WxHx4 and represents a RGBA
@@ -72,14 +76,24 @@ class Surface:
 
         Parameter y_origin ("top" or "bottom") decides whether point (0,0)
         lies in the top-left or bottom-left corner of the screen.
-        """
 
-        im = 0 + np.frombuffer(self._cairo_surface.get_data(), np.uint8)
-        im.shape = (self.height, self.width, 4)
-        im = im[:, :, [2, 1, 0, 3]]  # put RGB back in order
+        If `out` is given the pixels are copied into that preallocated
+        array instead of a new one.
+        """
+        if self._raw is None:
+            raw = np.frombuffer(self._cairo_surface.get_data(), np.uint8)
+            raw = raw.reshape(self.height, self._cairo_surface.get_stride() // 4, 4)
+            self._raw = raw[:, :self.width]
+        self._cairo_surface.flush()
+        raw = self._raw
         if y_origin == "bottom":
-            im = im[::-1]
-        return im if transparent else im[:, :, :3]
+            raw = raw[::-1]
+        if out is None:
+            out = np.empty((self.height, self.width, 4 if transparent else 3), np.uint8)
+        out[:, :, :3] = raw[:, :, 2::-1]  # BGR -> RGB
+        if transparent:
+            out[:, :, 3] = raw[:, :, 3]
+        return out
 
     def get_html_embed_code(self, y_origin="top"):
         """Return an html code containing all the PNG data of the surface. """
@@ -215,11 +229,10 @@ class Text(Element):
 
     def draw_contour(self, ctx):
         #print(f'draw text align={self.align}')
-        ctx.select_font_face(self.ff)
-        ctx.set_font_size(self.fontsize)
         if len(self.text) == 0:
             return
-        xbear, ybear, w, h, xadvance, yadvance = ctx.text_extents(self.text)
+        entry = textcache.default.get(ctx, self.ff, self.fontsize, self.text)
+        xbear, ybear, w, h, xadvance, yadvance = entry[0]
         #print(f'xbear:{xbear} ybear:{ybear} w:{w} h:{h}')
         self.w = w
         self.h = h
@@ -238,8 +251,7 @@ class Text(Element):
         elif self.align == 'bottom':
             x = self.x - w / 2 - xbear
             y = self.y - h - ybear
-        ctx.move_to(x, y)
-        ctx.text_path(self.text)
+        textcache.default.glyph_path(ctx, x, y, entry)
 
 
 class Group(Element):
@@ -342,3 +354,25 @@ class WithName(Element):
     def get_size(self):
         return self.body.get_size()
 
+
+# clips runnable as `python -m dvis <clip> [args]`, the module is only
+# imported when its clip is run so the command starts fast
+CLIPS = {
+    'quicksort': 'quick sort animation: [path (quicksort.mp4)] [trace.npz [start [stop]]]',
+    'mergesort': 'merge sort animation: [path (mergesort.mp4)] [trace.npz [start [stop]]]',
+    'leveldb': 'LSM animation of leveldb.log: [path (preview)] [duration]',
+    'phdb': 'PHDB hash table fill and overflow reassignment: [path (preview)]',
+}
+
+
+def main(argv):
+    if len(argv) == 0 or argv[0] not in CLIPS:
+        print('usage: python -m dvis <clip> [args], a path of null measures throughput')
+        for name, doc in CLIPS.items():
+            print(f'  {name:10s} {doc}')
+        sys.exit(0 if argv and argv[0] in ('-h', '--help') else 2)
+    importlib.import_module(argv[0]).main(argv[1:])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
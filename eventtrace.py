@@ -0,0 +1,131 @@
+import os
+import bisect
+from array import array
+import numpy as np
+
+
+class EventTrace:
+    """Compact record of how a clip's state changes from step to step.
+
+    The state is a set of named fixed length integer vectors (a sort's
+    data, its box colors, index markers...), read from an object's
+    attributes. Every record() stores only the positions that changed
+    since the previous step, as (position, value) pairs in flat arrays
+    with ptr[i] the start of step i; every checkpoint_every steps the full
+    state is stored too, so any step is rebuilt from the nearest checkpoint.
+    """
+
+    def __init__(self, fields, checkpoint_every=256):
+        self.fields = tuple(fields)
+        self.sizes = None
+        self.checkpoint_every = checkpoint_every
+        self.ptr = array('q', [0])
+        self.pos = array('i')
+        self.value = array('q')
+        self.ck_step = []
+        self.ck = []  # full state vectors at ck_step
+        self.last = None
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+    def _vector(self, obj):
+        vs = [np.asarray(getattr(obj, f), np.int64).ravel() for f in self.fields]
+        sizes = tuple(len(v) for v in vs)
+        if self.sizes is None:
+            self.sizes = sizes
+        elif sizes != self.sizes:
+            raise Exception(f'state sizes changed from {self.sizes} to {sizes}')
+        return np.concatenate(vs)
+
+    def record(self, obj):
+        """Append the current state of obj's fields as the next step."""
+        cur = self._vector(obj)
+        if self.last is not None:
+            changed = np.flatnonzero(cur != self.last)
+            self.pos.extend(changed.tolist())
+            self.value.extend(cur[changed].tolist())
+        self.ptr.append(len(self.pos))
+        if (len(self) - 1) % self.checkpoint_every == 0:
+            self.ck_step.append(len(self) - 1)
+            self.ck.append(cur)
+        self.last = cur
+
+    def _apply(self, vec, i):
+        a, b = self.ptr[i], self.ptr[i+1]
+        vec[np.frombuffer(self.pos, np.int32)[a:b]] = np.frombuffer(self.value, np.int64)[a:b]
+
+    def _split(self, vec):
+        ret = {}
+        o = 0
+        for f, n in zip(self.fields, self.sizes):
+            ret[f] = vec[o:o+n].tolist()
+            o += n
+        return ret
+
+    def state(self, i):
+        """{field: list} at step i."""
+        return self._split(self._vector_at(i))
+
+    def _vector_at(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        k = bisect.bisect_right(self.ck_step, i) - 1
+        vec = self.ck[k].copy()
+        for s in range(self.ck_step[k] + 1, i + 1):
+            self._apply(vec, s)
+        return vec
+
+    def replay(self, start=0, stop=None):
+        """Yield (step, {field: list}) for steps [start, stop), restarting
+        at start costs at most checkpoint_every steps of edits."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return
+        vec = self._vector_at(start)
+        yield start, self._split(vec)
+        for i in range(start + 1, stop):
+            self._apply(vec, i)
+            yield i, self._split(vec)
+
+    def save(self, path):
+        np.savez_compressed(path, fields=np.array(self.fields), sizes=np.array(self.sizes or (), np.int64),
+                            checkpoint_every=self.checkpoint_every,
+                            ptr=np.frombuffer(self.ptr, np.int64), pos=np.frombuffer(self.pos, np.int32),
+                            value=np.frombuffer(self.value, np.int64),
+                            ck_step=np.array(self.ck_step, np.int64), ck=np.array(self.ck, np.int64))
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as z:
+            t = EventTrace(z['fields'].tolist(), int(z['checkpoint_every']))
+            t.sizes = tuple(z['sizes'].tolist()) or None  # None until the first record()
+            t.ptr = array('q', z['ptr'].tobytes())
+            t.pos = array('i', z['pos'].tobytes())
+            t.value = array('q', z['value'].tobytes())
+            t.ck_step = z['ck_step'].tolist()
+            t.ck = list(z['ck'])
+        t.last = t._vector_at(len(t) - 1) if len(t) > 0 else None
+        return t
+
+
+def load_or_record(path, simulate):
+    """The trace saved at path, or simulate()'s trace saved there first.
+    np.savez adds .npz to any other path, so it is added here too."""
+    if not path.endswith('.npz'):
+        path += '.npz'
+    if os.path.exists(path):
+        return EventTrace.load(path)
+    trace = simulate()
+    trace.save(path)
+    return trace
+
+
+def run_traced(make_clip, default_path, argv):
+    """Command line of clips with simulate() and run(trace, start, stop):
+    [path [trace.npz [start [stop]]]]. A path of 'null' measures render
+    throughput without encoding; the trace is replayed if it exists and
+    recorded first otherwise, rendering only steps [start, stop) if given."""
+    clip = make_clip(argv[0] if len(argv) > 0 else default_path)
+    trace = load_or_record(argv[1], clip.simulate) if len(argv) > 1 else None
+    clip.run(trace, *map(int, argv[2:4]))
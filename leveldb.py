@@ -1,14 +1,17 @@
 import random
 import sys
-import json
+import numpy as np
 from clip import Clip
+from leveldb_trace import open_trace, plan_frames
 from colors import Set3
 
 
 class LevelDBClip(Clip):
-    def __init__(self, data, path):
-        super(LevelDBClip, self).__init__(1280, 800, path, 24)
-        self.data = [json.loads(e[4:]) for e in open(data).readlines()]
+    state_attrs = ('state',)
+
+    def __init__(self, data, path, **kw):
+        super(LevelDBClip, self).__init__(1280, 800, path, 24, **kw)
+        self.data = open_trace(data)
         n = len(self.data)
         print(f'total step: {n}')
         self.state = (None, None, None) # levels, delete, add
@@ -32,23 +35,33 @@ class LevelDBClip(Clip):
             total_size = sum(e['size'] for e in fs) // 1024
             self.canvas.text(-35, ys[i]+heights[i]//2, f'L{i}', 24, align='center')
             self.canvas.text(-35, ys[i]+heights[i]//2+24, f'{total_size//1024}M', 18, align='center')
+            if i > 0:
+                # files of a level do not overlap, draw them in one batch
+                if len(fs) == 0:
+                    continue
+                fids = np.array([f['id'] for f in fs])
+                size = np.array([f['size'] for f in fs])
+                s = np.array([f['start'] for f in fs]) // scale
+                e = np.array([f['end'] for f in fs]) // scale
+                w = np.maximum(1, e - s)
+                h = np.maximum(8, size // (w * 1800))
+                color = np.where(np.isin(fids, list(dels)), 1, np.where(np.isin(fids, list(adds)), 2, 0))
+                self.canvas.boxes(s, ys[i]+heights[i]//2-h//2, w, h, color, palette=Set3)
+                continue
             for idx,f in enumerate(fs):
                 fid = f['id']
-                color = Set3[0]
+                color = Set3.pattern(0)
                 if fid in dels:
-                    color = Set3[1]
+                    color = Set3.pattern(1)
                 elif fid in adds:
-                    color = Set3[2]
+                    color = Set3.pattern(2)
                 size = f['size']
                 s, e = f['start'] // scale, f['end'] // scale
                 w = max(1, e - s)
                 h = max(8, size // (w * 1800))
-                if i == 0:
-                    #print(f'level:{i} s:{s} e:{e} w:{w} h:{h}')
-                    th = h + len(fs)*8
-                    self.canvas.box(s, ys[i]+heights[i]//2-th//2+idx*8, w, h, color=color)
-                else:
-                    self.canvas.box(s, ys[i]+heights[i]//2-h//2, w, h, color=color)
+                #print(f'level:{i} s:{s} e:{e} w:{w} h:{h}')
+                th = h + len(fs)*8
+                self.canvas.box(s, ys[i]+heights[i]//2-th//2+idx*8, w, h, color=color)
 
     def on_step_back(self):
         if self.stepi >= 2:
@@ -85,10 +98,45 @@ class LevelDBClip(Clip):
         self.stepi = len(self.data) - 1
         self.wait(1)
         print(f'total frame: {self.nframe} {self.nframe/self.fps:.1f}s')
+        self.finish()
 
+    def show(self, i, holds=(1, 1)):
+        """Render trace step i, a compaction as its delete and add frames,
+        the j-th shown for holds[j] frames."""
+        e = self.data[i]
+        if isinstance(e, list):
+            states = [(e, None, None)]
+        else:
+            states = [(self.data[i-1], e['delete'], None), (self.data[i+1], None, e['add'])]
+        for state, hold in zip(states, holds):
+            self.state = state
+            self.step()
+            if hold > 1 and self.writer:
+                self.hold_frames(hold - 1)
 
-if __name__ == "__main__":
+    def run_planned(self, duration):
+        """Render a video of about duration seconds, steps picked by plan_frames."""
+        plan = plan_frames(self.data, duration, self.fps)
+        print(f'planned steps: {len(plan)}/{len(self.data)}')
+        for i, holds in plan:
+            self.stepi = i
+            self.show(i, holds)
+        self.wait(1)
+        print(f'total frame: {self.nframe} {self.nframe/self.fps:.1f}s')
+        self.finish()
+
+
+def main(argv):
+    # no path previews in a window, 'null' measures render throughput
     path = None
-    if len(sys.argv) > 1:
-        path = sys.argv[1]
-    LevelDBClip('leveldb.log', path).run()
+    if len(argv) > 0:
+        path = argv[0]
+    clip = LevelDBClip('leveldb.log', path, pipeline=8, vfr=True)
+    if len(argv) > 1:
+        clip.run_planned(float(argv[1]))
+    else:
+        clip.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
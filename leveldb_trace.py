@@ -0,0 +1,398 @@
+import os
+import sys
+import gzip
+import json
+import heapq
+import shutil
+from array import array
+from collections import OrderedDict
+import numpy as np
+
+
+def open_log(path):
+    """Open a trace log for binary reading, .gz and .zst are decompressed on the fly."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(f'reading {path} needs the zstandard package')
+        return zstandard.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _fresh(path, src):
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(src)
+
+
+def _save_npy(path, arr):
+    # best effort, the log may live in a read-only directory
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+class LevelDBTrace:
+    """Lazy, seekable view of a leveldb trace log.
+
+    Each line is `xxx {json}` with a 4 character prefix. Lines are parsed on
+    demand: an index of line offsets into the (decompressed) stream is built
+    in one streaming pass and kept next to the log as `<log>.idx.npy`, so
+    any step can be read with one seek. Recently read steps are cached,
+    which keeps stepping back cheap on compressed logs where a backward
+    seek means decompressing from the start.
+    """
+
+    def __init__(self, path, cache_size=256):
+        self.path = path
+        self.index_path = path + '.idx.npy'
+        self.offsets = self._load_index()
+        self.f = None
+        self.pos = 0  # position of self.f in the decompressed stream
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def _load_index(self):
+        if _fresh(self.index_path, self.path):
+            return np.load(self.index_path)
+        offsets = array('q')
+        pos = 0
+        with open_log(self.path) as f:
+            for line in f:
+                if line.strip():
+                    offsets.append(pos)
+                pos += len(line)
+        offsets = np.frombuffer(offsets, np.int64) if len(offsets) else np.zeros(0, np.int64)
+        _save_npy(self.index_path, offsets)
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getstate__(self):
+        # open file and cache are not carried over, e.g. to render workers
+        state = self.__dict__.copy()
+        state.update(f=None, pos=0, cache=OrderedDict())
+        return state
+
+    def _seek(self, off):
+        if self.f is None or (off < self.pos and self.path.endswith('.zst')):
+            # zstd streams only seek forward, start over
+            if self.f is not None:
+                self.f.close()
+            self.f = open_log(self.path)
+            self.pos = 0
+        if off != self.pos:
+            self.f.seek(off)
+            self.pos = off
+
+    def read_line(self, i):
+        """Raw json text of step i."""
+        self._seek(int(self.offsets[i]))
+        line = self.f.readline()
+        self.pos += len(line)
+        return line[4:]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        e = self.cache.get(i)
+        if e is None:
+            e = self.cache[i] = json.loads(self.read_line(i))
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(i)
+        return e
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+NUM_LEVELS = 7  # leveldb config::kNumLevels
+FORMAT = 2
+COLUMNS = ('meta', 'file_id', 'file_start', 'file_end', 'file_size', 'kind',
+           've_ptr', 've_op', 've_level', 've_pos', 've_row', 'ck_step', 'ck_ptr', 'ck_files',
+           'del_ptr', 'del_level', 'del_id', 'add_ptr', 'add_level', 'add_id')
+
+
+def diff_level(prev, cur):
+    """Version edit turning file list prev into cur: deletes as (pos, row)
+    in prev, adds as (pos, row) in cur."""
+    prev_set, cur_set = set(prev), set(cur)
+    dels = [(p, r) for p, r in enumerate(prev) if r not in cur_set]
+    adds = [(p, r) for p, r in enumerate(cur) if r not in prev_set]
+    return dels, adds
+
+
+def apply_level(files, dels, adds):
+    """Apply a diff_level edit in place."""
+    for p, r in reversed(dels):
+        del files[p]
+    for p, r in adds:
+        files.insert(p, r)
+
+
+def convert(path, out=None, checkpoint_every=256):
+    """Convert a trace log into the columnar directory read by LevelDBColumns.
+
+    Files get one row each in file_id/start/end/size (sst files are
+    immutable). kind[i] is 0 for a levels snapshot and 1 for a compaction,
+    whose deleted and added (level, id) pairs are the del_* / add_* ranges
+    [ptr[i], ptr[i+1]).
+
+    Level membership is delta encoded: ve_* holds, for snapshot step i in
+    [ve_ptr[i], ve_ptr[i+1]), the version edit from the previous snapshot
+    (op 0 delete / 1 add, level, position, file row). Every checkpoint_every
+    snapshots, and wherever an edit would not reproduce the snapshot's file
+    order, the full membership is stored as a checkpoint: ck_step[k] is the
+    step and level l holds ck_files[ck_ptr[k*NUM_LEVELS+l]:ck_ptr[k*NUM_LEVELS+l+1]].
+    Only the previous snapshot is kept in memory while converting.
+    """
+    out = out or path + '.cols'
+    rows = {}
+    c = {
+        'file_id': array('q'), 'file_start': array('q'), 'file_end': array('q'), 'file_size': array('q'),
+        'kind': array('b'),
+        've_ptr': array('q', [0]), 've_op': array('b'), 've_level': array('b'), 've_pos': array('i'), 've_row': array('i'),
+        'ck_step': array('q'), 'ck_ptr': array('q', [0]), 'ck_files': array('i'),
+        'del_ptr': array('q', [0]), 'del_level': array('b'), 'del_id': array('q'),
+        'add_ptr': array('q', [0]), 'add_level': array('b'), 'add_id': array('q'),
+    }
+
+    def row(f):
+        r = rows.get(f['id'])
+        if r is None:
+            r = rows[f['id']] = len(rows)
+            c['file_id'].append(f['id'])
+            c['file_start'].append(f['start'])
+            c['file_end'].append(f['end'])
+            c['file_size'].append(f['size'])
+        return r
+
+    prev = None
+    since_ck = 0
+    with open_log(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            e = json.loads(line[4:])
+            step = len(c['kind'])
+            if isinstance(e, list):
+                if len(e) > NUM_LEVELS:
+                    raise Exception(f'{len(e)} levels, more than {NUM_LEVELS}')
+                c['kind'].append(0)
+                cur = [[row(f) for f in e[l]] if l < len(e) else [] for l in range(NUM_LEVELS)]
+                exact = prev is not None
+                if prev is not None:
+                    for l in range(NUM_LEVELS):
+                        dels, adds = diff_level(prev[l], cur[l])
+                        apply_level(prev[l], dels, adds)
+                        exact = exact and prev[l] == cur[l]
+                        for op, edits in ((0, dels), (1, adds)):
+                            for p, r in edits:
+                                c['ve_op'].append(op)
+                                c['ve_level'].append(l)
+                                c['ve_pos'].append(p)
+                                c['ve_row'].append(r)
+                since_ck += 1
+                if not exact or since_ck >= checkpoint_every:
+                    c['ck_step'].append(step)
+                    for l in range(NUM_LEVELS):
+                        c['ck_files'].extend(cur[l])
+                        c['ck_ptr'].append(len(c['ck_files']))
+                    since_ck = 0
+                prev = cur
+            else:
+                c['kind'].append(1)
+            c['ve_ptr'].append(len(c['ve_op']))
+            for k in ('del', 'add'):
+                edits = [] if isinstance(e, list) else (e.get('delete' if k == 'del' else 'add') or [])
+                c[k + '_level'].extend(ed[0] for ed in edits)
+                c[k + '_id'].extend(ed[1] for ed in edits)
+                c[k + '_ptr'].append(len(c[k + '_id']))
+    c['meta'] = array('q', [FORMAT, NUM_LEVELS, checkpoint_every])
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    os.makedirs(out)
+    for name in COLUMNS:
+        if name == 'meta':
+            continue
+        np.save(os.path.join(out, name + '.npy'), np.array(c[name], dtype=c[name].typecode))
+    # written last, its mtime marks a complete conversion
+    np.save(os.path.join(out, 'meta.npy'), np.array(c['meta'], np.int64))
+    return out
+
+
+class LevelDBColumns:
+    """Memory-mapped columnar trace written by convert().
+
+    Level membership is rebuilt by a cursor holding one live version (a
+    list of file rows per level): moving forward applies the version edits
+    of the steps in between, anything else restarts from the nearest
+    checkpoint. Memory is the live files plus the checkpoints, a step
+    forward costs the size of its edit.
+
+    Indexing returns the same structures as LevelDBTrace (levels as lists
+    of {'id', 'start', 'end', 'size'} dicts, compactions as {'delete': [[level, id]],
+    'add': [[level, id]]}).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for name in COLUMNS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+        self.nlevel = int(self.meta[1])
+        self.cursor = -1  # step the live version belongs to
+        self.live = None
+
+    def __getstate__(self):
+        # map the files again on unpickling instead of copying the arrays
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def __len__(self):
+        return len(self.kind)
+
+    def _load_checkpoint(self, k):
+        p = self.ck_ptr[k * self.nlevel:(k + 1) * self.nlevel + 1].tolist()
+        self.live = [self.ck_files[p[l]:p[l + 1]].tolist() for l in range(self.nlevel)]
+        self.cursor = int(self.ck_step[k])
+
+    def _apply(self, i):
+        a, b = self.ve_ptr[i:i + 2].tolist()
+        if a == b:
+            return
+        ops, levels = self.ve_op[a:b].tolist(), self.ve_level[a:b].tolist()
+        poss, rs = self.ve_pos[a:b].tolist(), self.ve_row[a:b].tolist()
+        for l in set(levels):
+            dels = [(p, r) for op, lv, p, r in zip(ops, levels, poss, rs) if op == 0 and lv == l]
+            adds = [(p, r) for op, lv, p, r in zip(ops, levels, poss, rs) if op == 1 and lv == l]
+            apply_level(self.live[l], dels, adds)
+
+    def level_rows(self, i):
+        """File rows of each level in the version of step i, the last
+        snapshot at or before it. The lists are owned by the cursor."""
+        k = int(np.searchsorted(self.ck_step, i, side='right')) - 1
+        if k < 0:
+            return [[] for l in range(self.nlevel)]
+        ck = int(self.ck_step[k])
+        if not (ck <= self.cursor <= i):
+            self._load_checkpoint(k)
+        for j in range(self.cursor + 1, i + 1):
+            if self.kind[j] == 0:
+                self._apply(j)
+        self.cursor = i
+        return self.live
+
+    def _files(self, rows):
+        return [{'id': fid, 'start': s, 'end': e, 'size': size} for fid, s, e, size in zip(
+            self.file_id[rows].tolist(), self.file_start[rows].tolist(),
+            self.file_end[rows].tolist(), self.file_size[rows].tolist())]
+
+    def _edits(self, k, i):
+        a, b = getattr(self, k + '_ptr')[i:i + 2].tolist()
+        return [list(e) for e in zip(getattr(self, k + '_level')[a:b].tolist(), getattr(self, k + '_id')[a:b].tolist())]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if self.kind[i] == 0:
+            return [self._files(rows) for rows in self.level_rows(i)]
+        return {'delete': self._edits('del', i), 'add': self._edits('add', i)}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def plan_frames(trace, duration, fps, compaction_frames=2):
+    """Pick the steps worth rendering for a video of about `duration` seconds.
+
+    Compactions rank above all snapshots and among themselves by bytes
+    moved (deleted plus added file sizes), so large compactions always get
+    their frames; snapshots rank by how much the level sizes changed since
+    the previous snapshot, a trivial flush scoring next to nothing. One
+    streaming pass keeps only the best candidates that fit the frame budget
+    (a compaction costs compaction_frames frames). Returns [(step, holds)]
+    in step order, holds giving how many video frames each of the step's
+    rendered frames is shown. The budget is spread over the selection with
+    cumulative rounding, so the holds add up to duration * fps.
+    """
+    budget = max(1, int(duration * fps))
+    heap = []  # (rank, step, cost), lowest rank on top
+    cost = 0
+    sizes = {}  # id -> size of the files in the last snapshot
+    prev_levels = None
+    compaction = None  # (step, deleted bytes, added ids) waiting for the next snapshot
+    last = len(trace) - 1
+
+    def push(rank, step, c):
+        nonlocal cost
+        heapq.heappush(heap, (rank, step, c))
+        cost += c
+        while cost > budget and len(heap) > 1:
+            cost -= heapq.heappop(heap)[2]
+
+    for i, e in enumerate(trace):
+        if isinstance(e, list):
+            level_sizes = [sum(f['size'] for f in fs) for fs in e]
+            sizes = {f['id']: f['size'] for fs in e for f in fs}
+            if compaction is not None:
+                step, moved, added = compaction
+                moved += sum(sizes.get(fid, 0) for fid in added)
+                push((1, moved), step, compaction_frames)
+                compaction = None
+            elif prev_levels is None or i == last:
+                push((2, 0), i, 1)  # first and last state are always shown
+            else:
+                n = max(len(level_sizes), len(prev_levels))
+                change = sum(abs((level_sizes[l] if l < len(level_sizes) else 0) -
+                                 (prev_levels[l] if l < len(prev_levels) else 0)) for l in range(n))
+                push((0, change), i, 1)
+            prev_levels = level_sizes
+        elif 0 < i < last:
+            compaction = (i, sum(sizes.get(d[1], 0) for d in e['delete']), [a[1] for a in e['add']])
+    plan = sorted((step, c) for rank, step, c in heap)
+    ret = []
+    k = 0
+    for step, c in plan:
+        # frame k ends at round((k+1) * budget / cost) video frames
+        ret.append((step, tuple(max(1, round((j + 1) * budget / cost) - round(j * budget / cost))
+                                for j in range(k, k + c))))
+        k += c
+    return ret
+
+
+def open_trace(path, convert_log=True):
+    """Columnar cache of a trace log if it is newer than the log (converting
+    it first when convert_log), otherwise the lazy line reader."""
+    cols = path + '.cols'
+    meta = os.path.join(cols, 'meta.npy')
+    if not _fresh(meta, path) or int(np.load(meta)[0]) != FORMAT:
+        if not convert_log:
+            return LevelDBTrace(path)
+        convert(path, cols)
+    return LevelDBColumns(cols)
+
+
+if __name__ == "__main__":
+    for p in sys.argv[1:]:
+        print(f'{p} -> {convert(p)}')
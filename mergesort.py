@@ -1,11 +1,15 @@
 import random
+import sys
 from clip import Clip
+from eventtrace import EventTrace, run_traced
 
 
 class MergeSortClip(Clip):
-    def __init__(self, N, path):
+    state_attrs = ('data', 'pos')
+
+    def __init__(self, N, path, **kw):
         self.bw = 40
-        super(MergeSortClip, self).__init__(N*self.bw+40, 60, path, 4)
+        super(MergeSortClip, self).__init__(N*self.bw+40, 60, path, 4, **kw)
         self.data = list(range(N))
         self.pos = (0,0,0,0)
 
@@ -24,13 +28,16 @@ class MergeSortClip(Clip):
         bbox = self.canvas.text_box_list(20, 30, self.bw, 24, self.data, 'h', box_color=box_color)
         self.canvas.text_align_to(bbox, 'merge sort')
 
-    def run(self):
+    def simulate(self):
+        """Merge sort a shuffled list in place, recording the ranges of
+        every merge step instead of rendering it."""
+        trace = EventTrace(self.state_attrs)
         data = self.data
         random.shuffle(data)
 
         def dump(s, p1, p2, e):
             self.pos = (s, p1, p2, e)
-            self.step()
+            trace.record(self)
 
         def merge(arr, start, mid, end):
             os = start
@@ -67,10 +74,20 @@ class MergeSortClip(Clip):
                 mergeSort(arr, m + 1, r)
             merge(arr, l, m, r)
         mergeSort(data, 0, len(data)-1)
+        return trace
+
+    def run(self, trace=None, start=0, stop=None):
+        if trace is None:
+            trace = self.simulate()
+        self.replay(trace, start, stop)
         for i in range(10):
             self.step()
         self.finish()
 
 
+def main(argv):
+    run_traced(lambda path: MergeSortClip(20, path, vfr=True), 'mergesort.mp4', argv)
+
+
 if __name__ == "__main__":
-    MergeSortClip(20, 'mergesort.mp4').run()
+    main(sys.argv[1:])
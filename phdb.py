@@ -1,9 +1,12 @@
 import random
 import math
 import sys
+import bisect
+import heapq
+import itertools
 from canvas import Canvas
 from clip import Clip
-from colors import Set3
+from colors import Set3, Palette
 import numpy as np
 
 head_size = 64
@@ -25,6 +28,64 @@ def subpage_pack_size(nitem, item_size):
 
 page_head_pack = npad(head_size, subpage_padding)
 
+# render geometry, pixels per page row and per pack
+page_h = 4
+pack_w = 5
+
+# level of detail render palette: empty, page head, then lod_shades shades
+# each of own, relocated and overflowing subpages
+lod_shades = 8
+
+
+def _lod_palette():
+    def shade(c, k):
+        f = (k + 1) / lod_shades
+        return tuple(1 - f + f * v for v in c)
+    ret = [(1, 1, 1), (0.47, 0.47, 0.47)]
+    for c in (Set3[4], Set3[3], (0.6, 0, 0)):
+        ret += [shade(c, k) for k in range(lod_shades)]
+    return Palette(ret)
+
+
+lod_palette = _lod_palette()
+
+# subpage index combinations tried when picking what to move out of a page
+_subpage_combos = [np.array(list(itertools.combinations(range(16), k))) for k in (1, 2, 3)]
+
+
+def overflow_candidates(packs, limit):
+    """Pick the subpages to move out of every page whose packs exceed limit.
+
+    For each page take the single subpage, else the pair, else the triple
+    with the smallest pack sum that still covers the overflow (lowest
+    subpage indices on ties). packs is an (npage, 16) array, returns
+    (pids, subpids, sizes) arrays ordered by page.
+    """
+    over = packs.sum(axis=1) - limit
+    pages = np.flatnonzero(over > 0)
+    picked = []
+    for combos in _subpage_combos:
+        if len(pages) == 0:
+            break
+        sums = packs[pages][:, combos].sum(axis=2)  # (pages, combos)
+        fits = sums >= over[pages][:, None]
+        best = np.where(fits, sums, np.iinfo(sums.dtype).max).argmin(axis=1)
+        ok = fits[np.arange(len(pages)), best]
+        for sub in combos[best[ok]].T:
+            picked.append((pages[ok], sub))
+        pages = pages[~ok]
+    if len(pages) > 0:
+        p = packs[pages[0]]
+        raise Exception(f"no suitable candi: {p.tolist()} sum:{p.sum()}-limit:{limit}={p.sum()-limit}")
+    if len(picked) == 0:
+        empty = np.zeros(0, np.intp)
+        return empty, empty, empty
+    pids = np.concatenate([p for p, sub in picked])
+    subpids = np.concatenate([sub for p, sub in picked])
+    order = np.lexsort((subpids, pids))
+    pids, subpids = pids[order], subpids[order]
+    return pids, subpids, packs[pids, subpids]
+
 
 class HT:
     def __init__(self, memory_size, item_size):
@@ -34,182 +95,292 @@ class HT:
         self.pack_per_page = page_size // subpage_padding
         self.item_size = item_size
         self.npage = memory_size // page_size
-        self.pages = [0] * self.npage
-        self.subpages = [[0] * 16 for i in range(self.npage)]
-        self.subpage_packs = [[0] * 16 for i in range(self.npage)]
-        self.orig_assigns = [[(pid, i) for i in range(16)] for pid in range(self.npage)]
+        self.pages = np.zeros(self.npage, np.int32)
+        self.subpages = np.zeros((self.npage, 16), np.int32)
+        self.subpage_packs = np.zeros((self.npage, 16), np.int32)
+        self.orig_assigns = self._identity_assigns()
         self.assigns = self.orig_assigns
         self.nele = 0
         self.moved_item = None
+        self.poses = None  # cached get_subpage_poses()
+        # running page pack aggregates, page sums only ever grow
+        self.page_packs = np.zeros(self.npage, np.int64)
+        self.pack_hist = np.zeros(64, np.int64)  # number of pages per page pack sum
+        self.pack_hist[0] = self.npage
+        self.pack_total = 0
+        self.pack_min = 0
+        self.pack_max = 0
+        # pages per (band, page pack sum) for lod(nrow), kept up to date by
+        # put/put_many until reassign_overflows() moves subpages
+        self.lod_nrow = None
+        self.band_hist = None
+        self.lod_cache = None  # (nrow, poses, result) once subpages moved
+
+    def _identity_assigns(self):
+        # assignment of every subpage: (dest pid, order key within dest page),
+        # a page keeps its own subpages in index order (keys 0-15) and
+        # appends received ones after them (keys 16+)
+        return (np.repeat(np.arange(self.npage, dtype=np.int32)[:, None], 16, axis=1),
+                np.tile(np.arange(16, dtype=np.int32), (self.npage, 1)))
+
+    def _grow_hist(self, n):
+        if n >= len(self.pack_hist):
+            self.pack_hist = np.concatenate([self.pack_hist, np.zeros(max(n + 1, len(self.pack_hist)), np.int64)])
+
+    def _grow_band_hist(self, n):
+        if n >= self.band_hist.shape[1]:
+            self.band_hist = np.concatenate([self.band_hist, np.zeros_like(self.band_hist)], axis=1)
+            self._grow_band_hist(n)
 
     def put(self, v):
         subid = v & 0xfff
         pid = (v >> 12) % self.npage
         subpid = subid >> 8
         self.pages[pid] += 1
-        self.subpages[pid][subpid] += 1
-        self.subpage_packs[pid][subpid] = subpage_pack_size(self.subpages[pid][subpid], self.item_size)
+        self.subpages[pid, subpid] += 1
+        old = int(self.subpage_packs[pid, subpid])
+        new = subpage_pack_size(int(self.subpages[pid, subpid]), self.item_size)
+        self.subpage_packs[pid, subpid] = new
         self.nele+=1
+        if new != old:
+            s = int(self.page_packs[pid])
+            self._grow_hist(s + new - old)
+            self.pack_hist[s] -= 1
+            self.pack_hist[s + new - old] += 1
+            self.page_packs[pid] = s + new - old
+            self.pack_total += new - old
+            self.pack_max = max(self.pack_max, s + new - old)
+            self.poses = None
+            if self.band_hist is not None:
+                b = pid * self.lod_nrow // self.npage
+                self._grow_band_hist(s + new - old)
+                self.band_hist[b, s] -= 1
+                self.band_hist[b, s + new - old] += 1
+
+    def put_many(self, keys, chunk=1 << 24):
+        """Insert an array of keys, same result as put() on each of them."""
+        keys = np.asarray(keys, dtype=np.int64)
+        counts = np.zeros(self.npage * 16, np.int64)
+        for i in range(0, len(keys), chunk):
+            v = keys[i:i+chunk]
+            pid = (v >> 12) % self.npage
+            counts += np.bincount(pid * 16 + ((v & 0xfff) >> 8), minlength=self.npage * 16)
+        counts = counts.reshape(-1, 16)
+        self.subpages += counts.astype(np.int32)
+        self.pages += counts.sum(axis=1).astype(np.int32)
+        self.nele += len(keys)
+        touched = np.flatnonzero(counts.any(axis=1))
+        old = self.page_packs[touched]
+        self.subpage_packs[touched] = subpage_pack_size(self.subpages[touched], self.item_size)
+        new = self.subpage_packs[touched].sum(axis=1, dtype=np.int64)
+        if len(touched) > 0:
+            self._grow_hist(int(new.max()))
+            np.subtract.at(self.pack_hist, old, 1)
+            np.add.at(self.pack_hist, new, 1)
+            self.page_packs[touched] = new
+            self.pack_total += int((new - old).sum())
+            self.pack_max = max(self.pack_max, int(new.max()))
+            self.poses = None
+            if self.band_hist is not None:
+                band = touched * self.lod_nrow // self.npage
+                self._grow_band_hist(int(new.max()))
+                np.subtract.at(self.band_hist, (band, old), 1)
+                np.add.at(self.band_hist, (band, new), 1)
 
     def reassign_overflows(self):
         limit = (page_size - head_size) // subpage_padding
-
-        def candidates(sizes):
-            s = sum(sizes)
-            if s <= limit:
-                return None
-            N = len(sizes)
-            r = s - limit
-            candi1 = [(e, i) for i,e in enumerate(sizes) if e >= r]
-            if len(candi1) > 0:
-                return [min(candi1)]
-            candi2 = None
-            for i in range(N):
-                for j in range(i+1, N):
-                    v = sizes[i]+sizes[j]
-                    if v == r:
-                        return [(sizes[i], i), (sizes[j], j)]
-                    elif v > r and (candi2 is None or (v, i, j) < candi2):
-                        candi2 = (v, i, j)
-            if candi2:
-                return [(sizes[candi2[1]], candi2[1]), (sizes[candi2[2]], candi2[2])]
-            candi3 = None
-            for i in range(N):
-                for j in range(i+1, N):
-                    for k in range(j + 1, N):
-                        v = sizes[i]+sizes[j]+sizes[k]
-                        if v == r:
-                            return [(sizes[i], i), (sizes[j], j), (sizes[k], k)]
-                        elif v > r and (candi3 is None or (v, i, j, k) < candi3):
-                            candi3 = (v, i, j, k)
-            if candi3:
-                return [(sizes[candi2[1]], candi2[1]), (sizes[candi2[2]], candi2[2]), (sizes[candi2[3]], candi2[3])]
-            raise Exception(f"no suitable candi: {sizes} sum:{s}-limit:{limit}={r}")
-
-        cds = []
-        holes = []
-        pages = self.subpage_packs
-        for pid,p in enumerate(pages):
-            cs = candidates(p)
-            s = sum(p)
-            if cs:  # larger than limit
-                for c in cs:
-                    cds.append((c[0], pid, c[1]))  # cnt, pid, subpid
-                # if len(cs) == 2:
-                #     print(f"2 candi: {p} sum:{sum(p)}-limit:{limit}={sum(p)-limit} {cs[0][0]} {cs[1][0]}")
-            elif limit - s > 0:
-                holes.append((limit - s, pid)) # hole_cnt, pid
-        reassigns = []
-        #print('candidates: ' + ' '.join(f'{e[1]}:{e[0]}' for e in cds))
-        #print(f'holes: {holes}')
-        while len(cds) > 0:
-            cds.sort()
-            holes.sort()
-            c = cds[-1]
-            if len(holes) == 0 or c[0] > holes[-1][0]:
+        packs = self.subpage_packs
+        pids, subpids, cnts = overflow_candidates(packs, limit)
+        # free packs per page, only pages that are not overflowing have holes
+        free = limit - self.page_packs
+        holes = {}  # hole size -> heap of pids
+        for pid in np.flatnonzero(free > 0).tolist():
+            holes.setdefault(int(free[pid]), []).append(pid)
+        hole_sizes = sorted(holes)
+        reassigns = []  # (src pid, src subpid, dest pid, cnt)
+        # largest candidate first, each into the smallest hole that fits it
+        # (lowest pid on ties)
+        for k in np.lexsort((subpids, pids, cnts))[::-1].tolist():
+            c = int(cnts[k])
+            hi = bisect.bisect_left(hole_sizes, c)
+            if hi == len(hole_sizes):
                 raise Exception('assign failed, no holes or hole not large enough')
-            hole, hi = min((hole, hi) for hi, hole in enumerate(holes) if hole[0] >= c[0])
-            reassigns.append(((c[1],c[2]), holes[hi][1], c[0]))
-            #print(f'assign {reassigns[-1]} candis:{cds[-5:]} holes:{holes[-5:]}')
-            new_hole = holes[hi][0] - c[0]
-            if new_hole > 0:
-                holes[hi] = (new_hole, holes[hi][1])
-            else:
-                del holes[hi]
-            cds.pop()
-        #print(f'reassigns: {reassigns}')
+            hole = hole_sizes[hi]
+            dest = heapq.heappop(holes[hole])
+            if len(holes[hole]) == 0:
+                del holes[hole]
+                del hole_sizes[hi]
+            reassigns.append((int(pids[k]), int(subpids[k]), dest, c))
+            rest = hole - c
+            if rest > 0:
+                if rest not in holes:
+                    holes[rest] = []
+                    bisect.insort(hole_sizes, rest)
+                heapq.heappush(holes[rest], dest)
+        dest, order = self._identity_assigns()
         self.moved_item = 0
-        assigns = [[(pid, i) for i in range(16)] for pid in range(len(pages))]
-        for src, dest, cnt in reassigns:
-            assigns[dest].append(src)
-            assigns[src[0]].remove(src)
-            self.moved_item += cnt
+        if len(reassigns) > 0:
+            sp, ss, dp, cnt = (np.array(a) for a in zip(*reassigns))
+            # received subpages follow the page's own ones, in assignment order
+            o = np.argsort(dp, kind='stable')
+            rank = np.empty_like(o)
+            rank[o] = np.arange(len(o)) - np.searchsorted(dp[o], dp[o])
+            dest[sp, ss] = dp
+            order[sp, ss] = 16 + rank
+            self.moved_item = int(cnt.sum())
         self.orig_assigns = self.assigns
-        self.assigns = assigns
+        self.assigns = (dest, order)
+        self.poses = None
+        self.band_hist = None
 
     def get_subpage_poses(self):
-        pages = self.subpage_packs
-        # [[(dest_pid, cpos, len)]]
-        poses = [[(0,0,0)]*16 for i in range(len(pages))]
-        for dpid in range(len(self.subpage_packs)):
-            cpos = page_head_pack
-            for spid, ssubpid in self.assigns[dpid]:
-                l = pages[spid][ssubpid]
-                poses[spid][ssubpid] = (dpid, cpos, l)
-                cpos += l
-        return poses
+        """(dest_pid, cpos, len) arrays, each npage x 16, of where every
+        subpage is placed; cached until packs or assignments change."""
+        if self.poses is not None:
+            return self.poses
+        dest, order = self.assigns
+        d, l = dest.ravel(), self.subpage_packs.ravel()
+        idx = np.lexsort((order.ravel(), d))
+        sd, sl = d[idx], l[idx].astype(np.int64)
+        excl = np.cumsum(sl) - sl
+        # start of each destination page's run in the sorted order
+        starts = np.where(np.r_[True, sd[1:] != sd[:-1]], np.arange(len(sd)), 0)
+        starts = np.maximum.accumulate(starts)
+        cpos = np.empty_like(excl)
+        cpos[idx] = page_head_pack + excl - excl[starts]
+        self.poses = (dest, cpos.reshape(dest.shape), self.subpage_packs)
+        return self.poses
 
     def space_ratio(self):
         return self.nele * self.item_size / (self.npage * page_size)
 
     def stats(self):
-        page_packs = [sum(e) for e in self.subpage_packs]
-        pmin = min(page_packs)
-        pmax = max(page_packs)
-        pavg = sum(page_packs) / len(page_packs)
+        while self.pack_hist[self.pack_min] == 0:
+            self.pack_min += 1
+        pmin = self.pack_min
+        pmax = self.pack_max
+        pavg = self.pack_total / self.npage
         ret = f'size: {self.nele} #page:{self.npage} #pack/page:{self.pack_per_page} (min:{pmin} max:{pmax} avg:{pavg:.1f}) space_ratio:{self.space_ratio():.3f}'
         if self.moved_item and self.moved_item > 0:
             ret += f' move: {self.moved_item}/{self.nele} {self.moved_item/self.nele:.4f}'
         return ret
 
     def page_sizes(self):
-        poses = self.get_subpage_poses()
-        szs = [0] * self.npage
-        for pid in range(self.npage):
-            for subpid in range(16):
-                dpid, cpos, l = poses[pid][subpid]
-                szs[dpid] = max(szs[dpid], cpos+l)
+        dpid, cpos, l = self.get_subpage_poses()
+        szs = np.zeros(self.npage, np.int64)
+        np.maximum.at(szs, dpid.ravel(), (cpos + l).ravel())
         return szs
 
-    def render(self, canvas=None):
-        page_h = 4
-        pack_w = 5
+    def lod(self, nrow):
+        """Aggregate the pages into nrow bands of consecutive pages, one per
+        pixel row when the table is too tall to draw page by page. Returns
+        (nrow, npack) lod_palette indexes, npack covering overflowing packs
+        too: a cell is overflow if it is past the page end, else relocated
+        if any page of the band has a relocated subpage on that pack, else
+        own; its shade is the fraction of the band's pages using the pack.
+
+        Until reassign_overflows() every page holds its own subpages back to
+        back, so a band's coverage follows from how many of its pages have
+        each page pack sum. That histogram is built on the first call and
+        then updated by put/put_many, making a frame cost nrow * npack
+        whatever the table size. Once subpages moved the coverage is
+        rebuilt from all subpage positions, cached until they change."""
+        pages = np.bincount(np.arange(self.npage) * nrow // self.npage, minlength=nrow)
+        if self.moved_item is None:
+            # never reassigned, pages hold only their own subpages
+            if self.band_hist is None or self.lod_nrow != nrow:
+                self.lod_nrow = nrow
+                band = np.arange(self.npage) * nrow // self.npage
+                width = max(64, self.pack_max + 1)
+                self.band_hist = np.bincount(band * width + self.page_packs, minlength=nrow * width).reshape(nrow, width)
+            npack = max(self.pack_per_page, page_head_pack + self.pack_max)
+            # pages of the band whose sum is above x, at pack page_head_pack + x
+            above = pages[:, None] - self.band_hist[:, :self.pack_max + 1].cumsum(axis=1)
+            total = np.zeros((nrow, npack), np.int64)
+            total[:, page_head_pack:page_head_pack + self.pack_max] = above[:, :self.pack_max]
+            return self._lod_index(total, np.zeros_like(total), pages)
+        poses = self.get_subpage_poses()
+        if self.lod_cache is not None and self.lod_cache[0] == nrow and self.lod_cache[1] is poses:
+            return self.lod_cache[2]
+        dest, cpos, l = (a.ravel() for a in poses)
+        npack = max(self.pack_per_page, int((cpos + l).max()))
+        band = dest.astype(np.int64) * nrow // self.npage
+        moved = dest != np.repeat(np.arange(self.npage), 16)
+        # coverage per (moved, band, pack) from +1/-1 at subpage start/end
+        n = 2 * nrow * (npack + 1)
+        at = (moved * nrow + band) * (npack + 1)
+        used = (np.bincount(at + cpos, minlength=n) - np.bincount(at + cpos + l, minlength=n))
+        used = used.reshape(2, nrow, npack + 1).cumsum(axis=2)[:, :, :npack]
+        idx = self._lod_index(used.sum(axis=0), used[1], pages)
+        self.lod_cache = (nrow, poses, idx)
+        return idx
+
+    def _lod_index(self, total, moved, pages):
+        shade = np.clip(-(-total * lod_shades // np.maximum(pages, 1)[:, None]) - 1, 0, lod_shades - 1)
+        kind = np.where(moved > 0, 1, 0)
+        kind[:, self.pack_per_page:] = 2
+        idx = np.where(total > 0, 2 + kind * lod_shades + shade, 0)
+        idx[:, :page_head_pack] = 1
+        return idx
+
+    def render_height(self, max_height=2000):
+        """Pixel height of render(), pages are aggregated above max_height."""
+        return min(self.npage * page_h, max_height)
+
+    def render(self, canvas=None, max_height=2000):
+        height = self.render_height(max_height)
         if canvas is None:
-            canvas = Canvas(1500, self.npage * page_h + 20)
+            canvas = Canvas(1500, height + 20)
             canvas.translate(10, 10)
-        poses = self.get_subpage_poses()
-        for pid in range(self.npage):
-            canvas.box(0, page_h * pid, page_head_pack*pack_w, page_h, '777', 0)
-            for subpid in range(16):
-                dpid, cpos, l = poses[pid][subpid]
-                if l == 0:
-                    continue
-                if dpid == pid:
-                    canvas.box(cpos*pack_w, dpid*page_h, l*pack_w, page_h, Set3[subpid], 0)
-                else:
-                    canvas.box(cpos*pack_w, dpid*page_h, l*pack_w, page_h, Set3[subpid], 1)
+        if height < self.npage * page_h:
+            canvas.heatmap(0, 0, pack_w, 1, self.lod(height), palette=lod_palette, border=0)
+            canvas.box(0, 0, pack_w * self.pack_per_page, height, '0000')
+            return canvas
+        canvas.boxes(0, page_h * np.arange(self.npage), page_head_pack*pack_w, page_h, '777', 0)
+        dpid, cpos, l = (a.ravel() for a in self.get_subpage_poses())
+        spid = np.repeat(np.arange(self.npage), 16)
+        subpid = np.tile(np.arange(16), self.npage)
+        # subpages in their own page without border, relocated ones with
+        for border, m in ((0, dpid == spid), (1, dpid != spid)):
+            m &= l > 0
+            canvas.boxes(cpos[m]*pack_w, dpid[m]*page_h, l[m]*pack_w, page_h, subpid[m], border, palette=Set3)
         canvas.box(0, 0, pack_w * self.pack_per_page, page_h*self.npage,  '0000')
         return canvas
 
 
 class PHDBClip(Clip):
-    def __init__(self, item_size, memory_size, ratio, seed=0, path='phdb.mp4'):
+    state_attrs = ('ht',)
+
+    def __init__(self, item_size, memory_size, ratio, seed=0, path='phdb.mp4', max_height=2000, **kw):
         random.seed(seed)
+        self.rng = np.random.default_rng(seed)
         self.N = int(memory_size * ratio / item_size)
         self.ht = HT(memory_size, item_size)
         self.caption_height = 30
-        self.H = self.ht.npage * 4 + self.caption_height + 10
+        self.max_height = max_height
+        self.H = self.ht.render_height(max_height) + self.caption_height + 10
         self.W = 1500
-        super(PHDBClip, self).__init__(self.W, self.H, path, 4)
+        super(PHDBClip, self).__init__(self.W, self.H, path, 4, **kw)
 
     def render(self):
         self.canvas.clear()
         self.canvas.translate(10, self.caption_height)
-        self.ht.render(self.canvas)
+        self.ht.render(self.canvas, self.max_height)
         self.canvas.reset_translate()
         self.canvas.text(10, 20, self.ht.stats(), 18, align='left')
 
     def run(self):
         self.step()
         self.wait(1)
-        progress = 0
-        for i in range(self.N):
-            v = random.randint(0, 0xffffffff)
-            self.ht.put(v)
-            p = int(i / self.N * 40)
-            if p > progress:
-                progress = p
-                self.step()
+        keys = self.rng.integers(0, 0x100000000, self.N, dtype=np.int64)
+        # a frame each time another 1/40 of the keys is in
+        done = 0
+        for p in range(1, 40):
+            end = -(-p * self.N // 40)
+            self.ht.put_many(keys[done:end])
+            done = end
+            self.step()
+        self.ht.put_many(keys[done:])
         self.wait(1)
         self.ht.reassign_overflows()
         self.step()
@@ -218,10 +389,12 @@ class PHDBClip(Clip):
 
 
 class LevelPHDBSim(Clip):
-    def __init__(self, path):
+    state_attrs = ('l0', 'l1')
+
+    def __init__(self, path, **kw):
         self.l0 = 0
         self.l1 = 0
-        super(LevelPHDBSim, self).__init__(1200, 160, path, 4)
+        super(LevelPHDBSim, self).__init__(1200, 160, path, 4, **kw)
 
     def add(self, a):
         self.l0 += a
@@ -267,9 +440,14 @@ class LevelPHDBSim(Clip):
         self.finish()
 
 
-if __name__ == "__main__":
+def main(argv):
+    # no path previews in a window, 'null' measures render throughput
     path = None
-    if len(sys.argv) > 1:
-        path = sys.argv[1]
+    if len(argv) > 0:
+        path = argv[0]
     #LevelPHDBSim(path).run()
     PHDBClip(20, 1024*1024, 0.87, path=path).run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
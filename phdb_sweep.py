@@ -0,0 +1,131 @@
+import os
+import csv
+import time
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+from phdb import HT, page_size, head_size, subpage_padding
+
+FIELDS = ['item_size', 'memory_size', 'ratio', 'seed',
+          'nele', 'npage', 'pack_min', 'pack_max', 'pack_avg', 'overflow_pages',
+          'space_ratio', 'moved', 'moved_fraction', 'failed', 'error', 'seconds']
+KEY = ('item_size', 'memory_size', 'ratio', 'seed')
+
+
+def evaluate(item_size, memory_size, ratio, seed):
+    """Fill an HT like PHDBClip does (same keys for the same seed) and
+    reassign its overflowing subpages, without rendering anything.
+    Returns one result row as a dict of FIELDS."""
+    t = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    ht = HT(memory_size, item_size)
+    ht.put_many(rng.integers(0, 0x100000000, int(memory_size * ratio / item_size), dtype=np.int64))
+    limit = (page_size - head_size) // subpage_padding
+    ht.stats()  # brings pack_min up to date
+    row = dict(item_size=item_size, memory_size=memory_size, ratio=ratio, seed=seed,
+               nele=ht.nele, npage=ht.npage, pack_min=ht.pack_min, pack_max=ht.pack_max,
+               pack_avg=ht.pack_total / ht.npage,
+               overflow_pages=int((ht.page_packs > limit).sum()),
+               space_ratio=ht.space_ratio(), moved='', moved_fraction='', failed=0, error='')
+    try:
+        ht.reassign_overflows()
+        row['moved'] = ht.moved_item
+        row['moved_fraction'] = ht.moved_item / ht.nele if ht.nele else 0.0
+    except Exception as e:
+        row['failed'] = 1
+        row['error'] = str(e)
+    row['seconds'] = round(time.perf_counter() - t, 3)
+    return row
+
+
+def _evaluate(params):
+    return evaluate(*params)
+
+
+def grid(item_sizes, ratios, memory_sizes, seeds):
+    return [dict(zip(KEY, p)) for p in itertools.product(item_sizes, memory_sizes, ratios, seeds)]
+
+
+def _key(row):
+    return (int(row['item_size']), int(row['memory_size']), float(row['ratio']), int(row['seed']))
+
+
+def _done_keys(path):
+    # rows of an interrupted run, a torn last line is dropped and rewritten
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path, newline='') as f:
+        lines = f.readlines()
+    good = 1
+    for i, row in enumerate(csv.DictReader(lines), 1):
+        try:
+            if row['seconds'] in (None, ''):
+                break
+            done.add(_key(row))
+        except (TypeError, ValueError):
+            break
+        good = i + 1
+    if good < len(lines):
+        with open(path, 'w', newline='') as f:
+            f.writelines(lines[:good])
+    return done
+
+
+def _to_parquet(src, out):
+    try:
+        import pandas
+    except ImportError:
+        raise Exception(f'writing {out} needs the pandas package (with pyarrow or fastparquet)')
+    pandas.read_csv(src, keep_default_na=False, na_values={'moved': [''], 'moved_fraction': ['']}).to_parquet(out, index=False)
+
+
+def sweep(out, item_sizes, ratios, memory_sizes, seeds, workers=None):
+    """Evaluate every (item_size, memory_size, ratio, seed) of the grid on a
+    process pool and write one row per configuration to `out`.
+
+    Rows are appended to a CSV as they finish, so an interrupted sweep is
+    resumed by running it again: configurations already in the file are
+    skipped. For a .parquet `out` the CSV is `<out>.csv` and is converted
+    once the grid is complete.
+    """
+    journal = out + '.csv' if out.endswith('.parquet') else out
+    done = _done_keys(journal)
+    todo = [p for p in grid(item_sizes, ratios, memory_sizes, seeds) if _key(p) not in done]
+    # biggest tables first so the pool does not end on a long straggler
+    todo.sort(key=lambda p: -p['memory_size'] * p['ratio'] / p['item_size'])
+    print(f'{len(done)} done, {len(todo)} to go')
+    new = not os.path.exists(journal) or os.path.getsize(journal) == 0
+    with open(journal, 'a', newline='') as f:
+        w = csv.DictWriter(f, FIELDS)
+        if new:
+            w.writeheader()
+        if todo:
+            with multiprocessing.Pool(workers) as pool:
+                params = [tuple(p[k] for k in KEY) for p in todo]
+                for i, row in enumerate(pool.imap_unordered(_evaluate, params), 1):
+                    w.writerow(row)
+                    f.flush()
+                    status = f"failed: {row['error']}" if row['failed'] else f"moved {row['moved_fraction']:.4f}"
+                    print(f"[{i}/{len(todo)}] item:{row['item_size']} mem:{row['memory_size']} "
+                          f"ratio:{row['ratio']} seed:{row['seed']} {status}")
+    if journal != out:
+        _to_parquet(journal, out)
+    return out
+
+
+def _list(t):
+    return lambda s: [t(x) for x in s.split(',')]
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description='PHDB parameter sweep, results as CSV or Parquet')
+    p.add_argument('out', help='result file, .csv or .parquet, rerun to resume')
+    p.add_argument('--item-size', type=_list(int), default=[8, 16, 20, 32])
+    p.add_argument('--ratio', type=_list(float), default=[0.8, 0.85, 0.87, 0.9])
+    p.add_argument('--memory-size', type=_list(int), default=[1 << 20, 1 << 24])
+    p.add_argument('--seeds', type=int, default=4, help='seeds 0..n-1')
+    p.add_argument('--workers', type=int, default=None, help='default: cpu count')
+    a = p.parse_args()
+    sweep(a.out, a.item_size, a.ratio, a.memory_size, range(a.seeds), a.workers)
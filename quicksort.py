@@ -1,11 +1,15 @@
 import random
+import sys
 from clip import Clip
+from eventtrace import EventTrace, run_traced
 
 
 class QuickSortClip(Clip):
-    def __init__(self, N, path):
+    state_attrs = ('data', 'color', 'ij')
+
+    def __init__(self, N, path, **kw):
         self.bw = 40
-        super(QuickSortClip, self).__init__(N*self.bw+40, 80, path, 4)
+        super(QuickSortClip, self).__init__(N*self.bw+40, 80, path, 4, **kw)
         self.data = list(range(N))
 
     def render(self):
@@ -21,7 +25,10 @@ class QuickSortClip(Clip):
 #             self.canvas.line((lpad+(m+0.5)*self.bw, 60), (lpad+(m+0.5)*self.bw, 70))
         self.canvas.text_align_to(bbox, 'quick sort')
 
-    def run(self):
+    def simulate(self):
+        """Quick sort a shuffled list, recording every partition step
+        (pivot, i/j markers and box colors) instead of rendering it."""
+        trace = EventTrace(self.state_attrs)
         data = self.data
         random.shuffle(data)
         self.color = [0xffffff] * len(data)
@@ -31,7 +38,7 @@ class QuickSortClip(Clip):
 
         def dump():
             self.ij = (i,j)
-            self.step()
+            trace.record(self)
 
         def sub_partition(array, start, end):
             pivot = array[start]
@@ -70,10 +77,20 @@ class QuickSortClip(Clip):
             quicksort(array, start, i - 1)
             quicksort(array, i + 1, end)
         quicksort(data, 0, len(data)-1)
+        return trace
+
+    def run(self, trace=None, start=0, stop=None):
+        if trace is None:
+            trace = self.simulate()
+        self.replay(trace, start, stop)
         for i in range(10):
             self.step()
         self.finish()
 
 
+def main(argv):
+    run_traced(lambda path: QuickSortClip(20, path, vfr=True), 'quicksort.mp4', argv)
+
+
 if __name__ == "__main__":
-    QuickSortClip(20, 'quicksort.mp4').run()
+    main(sys.argv[1:])
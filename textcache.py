@@ -0,0 +1,53 @@
+from collections import OrderedDict
+import cairocffi as cairo
+
+
+class TextCache:
+    """LRU cache of text extents and shaped glyph runs.
+
+    Entries are keyed by (font face, size, text, linear part of the CTM)
+    and hold the glyphs positioned at the origin together with the scaled
+    font they were shaped with, so a label drawn on every frame is shaped
+    once and afterwards only needs a glyph_path at its position.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.faces = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, ctx, face, size, text):
+        """Return (extents, glyphs, scaled_font) for text, face '' is cairo's default face."""
+        key = (face, size, text, ctx.get_matrix().as_tuple()[:4])
+        e = self.entries.get(key)
+        if e is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return e
+        self.misses += 1
+        ff = self.faces.get(face)
+        if ff is None:
+            ff = self.faces[face] = cairo.ToyFontFace(face)
+        ctx.set_font_face(ff)
+        ctx.set_font_size(size)
+        sf = ctx.get_scaled_font()
+        e = (ctx.text_extents(text), sf.text_to_glyphs(0, 0, text, False), sf)
+        self.entries[key] = e
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return e
+
+    @staticmethod
+    def glyph_path(ctx, x, y, entry):
+        """Append the glyph run of a cache entry to the current path at (x, y)."""
+        extents, glyphs, sf = entry
+        ctx.set_scaled_font(sf)
+        ctx.save()
+        ctx.translate(x, y)
+        ctx.glyph_path(glyphs)
+        ctx.restore()
+
+
+default = TextCache()
@@ -0,0 +1,64 @@
+import json
+import numpy as np
+
+# histogram bucket upper bounds in seconds, +Inf is implied
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Timings:
+    """Per phase duration histograms with fixed bucket bounds, cheap enough
+    to update on every frame. Phases are reported in the order first seen."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = np.array(buckets)
+        self.phases = {}  # name -> [bucket counts, count, sum, max]
+
+    def add(self, phase, sec):
+        h = self.phases.get(phase)
+        if h is None:
+            h = self.phases[phase] = [np.zeros(len(self.buckets) + 1, np.int64), 0, 0.0, 0.0]
+        h[0][np.searchsorted(self.buckets, sec)] += 1
+        h[1] += 1
+        h[2] += sec
+        h[3] = max(h[3], sec)
+
+    def quantile(self, phase, q):
+        """Upper bound of the bucket holding quantile q, the max for the last bucket."""
+        counts, n, total, mx = self.phases[phase]
+        i = int(np.searchsorted(np.cumsum(counts), q * n))
+        return min(self.buckets[i], mx) if i < len(self.buckets) else mx
+
+    def summary(self):
+        ret = {}
+        for phase, (counts, n, total, mx) in self.phases.items():
+            ret[phase] = {'count': n, 'sum': total, 'mean': total / n, 'max': mx,
+                          'p50': self.quantile(phase, 0.5), 'p90': self.quantile(phase, 0.9),
+                          'p99': self.quantile(phase, 0.99),
+                          'buckets': dict(zip([*map(str, self.buckets), '+Inf'], counts.tolist()))}
+        return ret
+
+    def format(self):
+        total = sum(h[2] for h in self.phases.values())
+        lines = [f"{'phase':10s} {'count':>7s} {'total s':>9s} {'share':>6s} {'mean ms':>8s} {'p50<=':>8s} {'p99<=':>8s} {'max ms':>8s}"]
+        for phase, s in self.summary().items():
+            lines.append(f"{phase:10s} {s['count']:7d} {s['sum']:9.3f} {s['sum']/total if total else 0:6.1%} "
+                         f"{s['mean']*1000:8.3f} {s['p50']*1000:8.3f} {s['p99']*1000:8.3f} {s['max']*1000:8.3f}")
+        return '\n'.join(lines)
+
+    def prometheus(self, name='dvis_frame_phase_seconds'):
+        """Prometheus text exposition format, one histogram labelled by phase."""
+        lines = [f'# HELP {name} Time spent per frame in each clip phase.', f'# TYPE {name} histogram']
+        for phase, (counts, n, total, mx) in self.phases.items():
+            for le, c in zip([*map(repr, self.buckets.tolist()), '+Inf'], np.cumsum(counts).tolist()):
+                lines.append(f'{name}_bucket{{phase="{phase}",le="{le}"}} {c}')
+            lines.append(f'{name}_sum{{phase="{phase}"}} {total!r}')
+            lines.append(f'{name}_count{{phase="{phase}"}} {n}')
+        return '\n'.join(lines) + '\n'
+
+    def save(self, path):
+        """Write the summary to path, Prometheus text for .prom else JSON."""
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.summary(), f, indent=1)